@@ -0,0 +1,219 @@
+import os
+import logging
+import tarfile
+import zipfile
+import subprocess
+import multiprocessing
+
+from tank.errors import TankError
+
+from .copier import CopyCancelled
+from .throttle import ThrottledWriter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+ARCHIVE_FORMATS = ['tar', 'tar.zst', 'zip']
+
+
+def archive_root(archive_path, destinations):
+    """
+    Find the directory archive member names are relative to.
+
+    Members keep the names the delivery templates produced, relative to
+    the directory the archive is written to. If some destinations live
+    outside of it the closest common directory is used instead.
+    """
+    root = os.path.dirname(archive_path)
+    prefix = root.rstrip(os.sep) + os.sep
+
+    if all(d.startswith(prefix) for d in destinations):
+        return root
+
+    return os.path.dirname(os.path.commonprefix(destinations))
+
+
+class ArchiveWriter(object):
+    """
+    Stream delivery files straight into a single tar, tar.zst or zip archive.
+
+    Only tar.zst is compressed, on several threads. Zip members are stored
+    uncompressed, deflate would compress the whole delivery on one thread.
+
+    The archive is written next to its final location with a .part suffix
+    and renamed once it was closed successfully, so the vendor never picks up
+    a half written archive.
+
+    Usage:
+
+        >>> with ArchiveWriter('/dl/title.tar.zst', 'tar.zst', '/dl') as a:
+        ...     a.add('/prj/shot/comp.1001.dpx', '/dl/title/shot.1001.dpx')
+    """
+
+    def __init__(self, path, archive_format, root, workers=None, level=None,
+                 limiter=None, cancel_event=None, dry_run=False):
+        """
+        :param path: Final archive path
+        :param archive_format: One of ARCHIVE_FORMATS
+        :param root: Directory member names are relative to
+        :param workers: Number of compression threads. Defaults to CPU count
+        :param level: tar.zst compression level. Zip archives only accept 0
+        :param limiter: BandwidthLimiter the tar stream or the zip
+            file writes go through
+        :param cancel_event: threading.Event that stops writing the
+            archive once it is set
+        :param dry_run: Only log the operations without touching the disk
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise TankError(
+                'Archive format "%s" is not supported. Use one of: %s'
+                % (archive_format, ', '.join(ARCHIVE_FORMATS))
+            )
+        if archive_format == 'zip' and level:
+            raise TankError(
+                'Zip archives are stored uncompressed, archive_level %s is not '
+                'supported. Use tar.zst for compressed archives' % level
+            )
+
+        self.path = path
+        self.format = archive_format
+        self.root = root
+        self.workers = workers or multiprocessing.cpu_count()
+        self.level = level
+        self.limiter = limiter
+        self.cancel_event = cancel_event
+        self.dry_run = dry_run
+
+        self._part_path = path + '.part'
+        self._fh = None
+        self._zstd_writer = None
+        self._zstd_proc = None
+        self._archive = None
+
+        if not self.dry_run:
+            self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(abort=exc_type is not None)
+
+    def _throttled(self, fileobj):
+        if self.limiter is None and self.cancel_event is None:
+            return fileobj
+        return ThrottledWriter(fileobj, self.limiter, self.cancel_event)
+
+    def _open(self):
+
+        archive_dir = os.path.dirname(self.path)
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+
+        if self.format == 'tar':
+            self._fh = open(self._part_path, 'wb')
+            self._archive = tarfile.open(fileobj=self._throttled(self._fh), mode='w')
+
+        elif self.format == 'zip':
+            self._fh = open(self._part_path, 'wb')
+            self._archive = zipfile.ZipFile(
+                self._throttled(self._fh), 'w', zipfile.ZIP_STORED, allowZip64=True
+            )
+
+        elif zstandard is not None:
+            # Zstandard compresses the tar stream on its own worker threads
+            cctx = zstandard.ZstdCompressor(
+                level=self.level or 3, threads=self.workers
+            )
+            self._fh = open(self._part_path, 'wb')
+            self._zstd_writer = cctx.stream_writer(self._fh)
+            self._archive = tarfile.open(
+                fileobj=self._throttled(self._zstd_writer), mode='w|'
+            )
+
+        else:
+            # Fall back to zstd command line tool if the python module
+            # is not available in the current environment
+            cmd = [
+                'zstd', '-q', '-f', '-T%d' % self.workers,
+                '-%d' % (self.level or 3), '-o', self._part_path
+            ]
+            try:
+                self._zstd_proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            except OSError as e:
+                raise TankError(
+                    'tar.zst archives require zstandard python module '
+                    'or zstd command line tool. %s' % e
+                )
+            self._archive = tarfile.open(
+                fileobj=self._throttled(self._zstd_proc.stdin), mode='w|'
+            )
+
+        log.info('Writing %s archive %s' % (self.format, self.path))
+
+    def member_name(self, dst):
+        """ Archive member name for the delivery destination path """
+        name = os.path.relpath(dst, self.root)
+        return name.replace(os.sep, '/')
+
+    def add(self, src, dst):
+        """
+        Stream a single file into the archive
+
+        :param src: Source file path
+        :param dst: Destination path the delivery template produced for this file
+        :returns: Number of bytes added
+        """
+        size = os.path.getsize(src)
+        name = self.member_name(dst)
+
+        if self.dry_run:
+            log.debug('Archive %s -> %s:%s' % (src, self.path, name))
+            return size
+
+        if self.format == 'zip':
+            self._archive.write(src, name)
+        else:
+            self._archive.add(src, arcname=name, recursive=False)
+
+        return size
+
+    def close(self, abort=False):
+        """
+        Finalize the archive and move it to its final location
+
+        :param abort: Discard the partially written archive instead
+        """
+        if self.dry_run or self._archive is None:
+            return
+
+        try:
+            self._archive.close()
+        except (CopyCancelled, IOError, OSError):
+            # Cancelled writers refuse the end of archive records
+            if not abort:
+                raise
+        self._archive = None
+
+        if self._zstd_writer is not None:
+            self._zstd_writer.close()
+        if self._fh is not None and not self._fh.closed:
+            self._fh.close()
+
+        if self._zstd_proc is not None:
+            self._zstd_proc.stdin.close()
+            if self._zstd_proc.wait() != 0 and not abort:
+                raise TankError('zstd failed to compress %s' % self.path)
+
+        if abort:
+            log.warning('Removing incomplete archive %s' % self._part_path)
+            os.remove(self._part_path)
+            return
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self._part_path, self.path)
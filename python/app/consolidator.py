@@ -1,14 +1,27 @@
 import os
 import sys
 import re
+import json
+import hashlib
 import argparse
 import logging
+import time
+import threading
 import sgtk
 
 import asset
 from asset import asset_from_path
 from tank.errors import TankError
 
+from .plan import CopyItem, CopyPlan
+from .copier import Copier, CopyCancelled
+from .scheduler import Scheduler, build_tasks
+from .workqueue import WorkQueue, QueuedAsset, make_shards
+from .writeback import WriteBack
+from .throttle import BandwidthLimiter, set_low_priority, throughput_summary
+from .versions import FinalVersionIndex, compile_version_patterns
+from .archive import ArchiveWriter, archive_root
+
 debug = os.environ.get('DRY_RUN', False)
 
 # Get logger for the current app namespace
@@ -27,7 +40,13 @@ class Delivery(object):
     for faster access
     """
 
-    def __init__(self, sg_instance, sg_id):
+    def __init__(self, sg_instance, sg_id, write_back=False):
+        """
+        :param sg_instance: Shotgun API instance
+        :param sg_id: Delivery entity id
+        :param write_back: Also fetch fields consolidation results are
+            written to, so unchanged values are not written again
+        """
 
         # NOTE(Kirill): self._app dependency is not desirable here
         self._app = sgtk.platform.current_bundle()
@@ -45,6 +64,11 @@ class Delivery(object):
             'sg_due_date'
         ]
 
+        # Optional fields that are fetched along with the required ones
+        self.write_back_fields = []
+        if write_back:
+            self.write_back_fields = WriteBack.query_fields(self._app)
+
         self.id = int(sg_id)
         self.sg_data = self._get_data()
 
@@ -60,7 +84,8 @@ class Delivery(object):
             ['project', 'is', self._app.context.project],
             ['id', 'is', self.id]
         ]
-        sg_delivery = self.sg.find_one(self.sg_entity_type, filters, self.sg_fields)
+        fields = self.sg_fields + self.write_back_fields
+        sg_delivery = self.sg.find_one(self.sg_entity_type, filters, fields)
 
         for f in self.sg_fields:
             if f in sg_delivery:
@@ -181,7 +206,10 @@ class Delivery(object):
         filters = [
             {'filter_operator': 'any', 'filters': version_filters}
         ]
-        fields = ['sg_path_to_frames', 'sg_path_to_movie', 'code', 'entity']
+        fields = [
+            'sg_path_to_frames', 'sg_path_to_movie', 'code', 'entity',
+            'entity.Shot.sg_cut_in', 'entity.Shot.sg_cut_out'
+        ] + self.write_back_fields
         delivery_versions = self.sg.find('Version', filters, fields)
 
         self.__versions = delivery_versions
@@ -206,7 +234,10 @@ class Delivery(object):
         filters = [
             {'filter_operator': 'any', 'filters': filters}
         ]
-        fields = ['path', 'code', 'entity']
+        fields = [
+            'path', 'code', 'entity',
+            'entity.Shot.sg_cut_in', 'entity.Shot.sg_cut_out'
+        ] + self.write_back_fields
         delivery_publishes = self.sg.find('PublishedFile', filters, fields)
 
         self.__published_files = delivery_publishes
@@ -250,9 +281,6 @@ class Delivery(object):
                 log.error('Can not create asset from path %s. %s' % (path_to_asset, e))
                 raise
 
-            fin_version = self.all_delivery_versions.get(v['entity']['id'])
-            asset.extra_attrs['final_version'] = fin_version
-
             asset.sg_data = v
             dl_assets.append(asset)
             delivery_paths.append(path_to_asset)
@@ -272,9 +300,6 @@ class Delivery(object):
 
             asset = asset_from_path(path_to_asset)
 
-            fin_version = self.all_delivery_versions.get(v['entity']['id'])
-            asset.extra_attrs['final_version'] = fin_version
-
             asset.sg_data = v
             dl_assets.append(asset)
             delivery_paths.append(path_to_asset)
@@ -294,7 +319,7 @@ class Delivery(object):
                 continue
 
             if not local_path:
-                log.warning('Local path is empty for %s' % v['code'])
+                log.warning('Local path is empty for %s' % p['code'])
                 continue
 
             if local_path in delivery_paths:
@@ -302,9 +327,6 @@ class Delivery(object):
 
             asset = asset_from_path(local_path)
 
-            fin_version = self.all_delivery_versions.get(v['entity']['id'])
-            asset.extra_attrs['final_version'] = fin_version
-
             asset.sg_data = p
             dl_assets.append(asset)
             delivery_paths.append(local_path)
@@ -312,6 +334,100 @@ class Delivery(object):
         return dl_assets
 
 
+class ProgressReporter(object):
+    """
+    Receive progress notifications from a running Consolidator.
+
+    This base class does nothing, subclass it to present the progress
+    to the user. Note that asset and file notifications are called from
+    the copy worker threads, several assets can be in progress at once.
+    """
+
+    def run_started(self, plan):
+        """ :param plan: CopyPlan that is about to be consolidated """
+        pass
+
+    def asset_started(self, item):
+        pass
+
+    def file_copied(self, item, src, dst, size):
+        """ Called for every file (or sequence frame) that has been copied """
+        pass
+
+    def asset_completed(self, item):
+        pass
+
+    def asset_failed(self, asset, message):
+        pass
+
+    def run_throughput(self, copied, elapsed, limiter, metadata=None):
+        """
+        Called before run_finished once the copy is over
+
+        :param copied: Number of bytes copied by this run
+        :param elapsed: Copy time in seconds
+        :param limiter: BandwidthLimiter the copies went through
+        :param metadata: MetadataCounter of the file system operations
+        """
+        pass
+
+    def run_finished(self, assets, completed, cancelled):
+        """
+        :param assets: List of all assets that were requested for consolidation
+        :param completed: List of assets that were successfully consolidated
+        :param cancelled: True if the run was cancelled before it finished
+        """
+        pass
+
+
+class ConsoleReporter(ProgressReporter):
+    """
+    Reporter used in command line mode. Prints final summary for the user
+    """
+
+    def __init__(self, delivery_title):
+        self.delivery_title = delivery_title
+        self.throughput = None
+        self.metadata = None
+
+    def run_throughput(self, copied, elapsed, limiter, metadata=None):
+        self.throughput = throughput_summary(copied, elapsed, limiter)
+        if metadata is not None:
+            self.metadata = 'Metadata operations: %s' % metadata.describe()
+
+    def run_finished(self, assets, completed, cancelled):
+
+        asset_not_completed = [a for a in assets if a not in completed]
+
+        print ''
+
+        if self.throughput is not None:
+            print self.throughput
+            if self.metadata is not None:
+                print self.metadata
+            print ''
+
+        if cancelled:
+            print 'WARNING! Consolidation was cancelled.'
+            print ''
+
+        if len(completed) < len(assets):
+            print 'WARNING! The following assets were not consolidated:'
+            for i, asset in enumerate(asset_not_completed):
+                print ''
+                print '    %s. %s' % (i+1, asset.name)
+            print ''
+            print (
+              'Please review your consolidation log. '
+              'You might be able to force consolidation of this assets by running consolidator with -f flag.'
+            )
+        else:
+            print (
+                'All assets have been consolidated for "%s" delivery. Yay! :)'
+                % self.delivery_title
+            )
+
+
 class Consolidator(object):
     """
     This is main application class. It responsible for hight level logic such as
@@ -335,11 +451,13 @@ class Consolidator(object):
             >>> tank consolidator -id 12 -stf PublishedFile
     """
 
-    def __init__(self, app, sg_delivery, options):
+    def __init__(self, app, sg_delivery, options, reporter=None):
         """
         :param app: Shotgun Toolkit application instance
         :param sg_delivery: Delivery object that consolidator run for
         :param options: Options dictionary that come from command line or UI
+        :param reporter: ProgressReporter instance that receives progress
+            notifications. Defaults to ConsoleReporter
         """
 
         self._app = app
@@ -348,18 +466,133 @@ class Consolidator(object):
         self.sg_delivery = sg_delivery
         self.opt = options
 
+        if reporter is None:
+            reporter = ConsoleReporter(self.sg_delivery.title)
+        self.reporter = reporter
+
+        self.limiter = self.get_bandwidth_limiter()
+        self._cancelled = threading.Event()
+        self._shard_stopped = None  # Stops the shard copied in worker mode
+
+        # Checksums are only needed to record them on Shotgun
+        checksum = 'md5' if self.opt.write_back else None
+        self.copier = Copier.from_app(
+            self._app, checksum=checksum, limiter=self.limiter,
+            cancel_event=self._cancelled, dry_run=bool(debug)
+        )
+
+        # Copy threads lower their own priority, the host process is left alone
+        initializer = None
+        if self.opt.low_priority or self._app.get_setting('low_priority', False):
+            initializer = set_low_priority
+
+        workers = self.opt.workers or self._app.get_setting('copy_workers', 4)
+        self.scheduler = Scheduler(workers, initializer=initializer)
+
+        self.assets = []  # All assets requested for consolidation
+        self._archive = None  # ArchiveWriter for archive delivery types
+
+        # Copy progress shared between the workers
+        self._lock = threading.Lock()
+        self._remaining = {}  # Number of files left to copy by CopyItem
+        self._failed = set()  # CopyItems that failed to copy
+        self._completed = []  # Assets that have been successfuly consolidated
+        self._bytes_copied = 0
+        self._files_copied = 0
+
         if self.opt.sg_type_filter is not None:
             self.sg_type_filter = self.opt.sg_type_filter
         else:
             self.sg_type_filter = []
 
         if self.opt.extension_filter is not None:
-            # All file extension filters should be lowercase
-            self.ext_filter = [i.lower() for i in self.opt.extension_filter]
+            # All file extension filters should be lowercase, without the dot
+            self.ext_filter = [i.lower().lstrip('.') for i in self.opt.extension_filter]
         else:
             self.ext_filter = []
 
-    def _find_sequence_range(self, path):
+        # Patterns final version numbers are parsed from
+        self.version_patterns = compile_version_patterns(
+            self._app.get_setting('version_patterns', None)
+        )
+        self._final_versions = None
+
+        # Frame ranges by asset name, None key holds range for all assets
+        self.frame_ranges = dict(
+            (name, (first, last))
+            for name, first, last in self.opt.frame_range or []
+        )
+
+    def cancel(self):
+        """
+        Request running consolidation to stop. It is safe to call this method
+        from any thread. Files that are currently copied stop after the chunk
+        in flight.
+        """
+        self._cancelled.set()
+        shard_stopped = self._shard_stopped
+        if shard_stopped is not None:
+            shard_stopped.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _notify(self, name, *args):
+        """
+        Call the reporter method. Reporter errors are logged, they
+        should never stop files from being copied
+        """
+        try:
+            getattr(self.reporter, name)(*args)
+        except Exception:
+            log.exception('Progress reporter failed in %s' % name)
+
+    def _fail(self, asset, message):
+        """ Log asset error and notify the reporter about it """
+        log.error(message)
+        self._notify('asset_failed', asset, message)
+
+    def _find_sequence_frames(self, template, fields, frame_range=None):
+        """
+        Find frames of the sequence on disk.
+
+        When a frame range is given only the frames inside of it are probed
+        on disk instead of listing every file of the sequence.
+
+        :param template: Template matching the sequence path
+        :param fields: Fields extracted from the sequence path
+        :param frame_range: Optional (first, last) tuple
+        :returns: Sorted list of (frame, path) tuples
+        """
+        frames = []
+
+        # Stereo sequences have several files per frame
+        # so they still need to be listed by the template system
+        if frame_range is not None and 'eye' not in fields:
+            first, last = frame_range
+            for frame in range(first, last + 1):
+                frame_fields = dict(fields)
+                frame_fields['SEQ'] = frame
+                path = template.apply_fields(frame_fields)
+                self.copier.metadata.add('stat')
+                if os.path.exists(path):
+                    frames.append((frame, path))
+            return frames
+
+        self.copier.metadata.add('listdir')
+        for path in self.tk.paths_from_template(template, fields, ['SEQ', 'eye']):
+            frame = template.get_fields(path).get('SEQ')
+            if frame is None:
+                continue
+            if frame_range is not None:
+                if frame < frame_range[0] or frame > frame_range[1]:
+                    continue
+            frames.append((frame, path))
+
+        return sorted(frames)
+
+    def _find_sequence_range(self, path, frame_range=None):
         """
         Helper method attempting to extract sequence information.
 
@@ -368,12 +601,14 @@ class Consolidator(object):
         attempted to be extracted.
 
         :param path: Path to file on disk.
+        :param frame_range: Optional (first, last) tuple. Only frames
+            inside of this range are looked up on disk
         :returns: None if no range could be determined, otherwise (min, max)
         """
         # # find a template that matches the path:
         template = None
         try:
-            template = self.parent.sgtk.template_from_path(path)
+            template = self.tk.template_from_path(path)
         except TankError:
             pass
 
@@ -385,47 +620,56 @@ class Consolidator(object):
         if "SEQ" not in fields:
             return None
 
-        files = self.parent.sgtk.paths_from_template(template, fields, ["SEQ", "eye"])
-
-        # find frame numbers from these files:
-        frames = []
-        for file in files:
-            fields = template.get_fields(file)
-            frame = fields.get("SEQ")
-            if frame is not None:
-                frames.append(frame)
+        frames = [f for f, p in self._find_sequence_frames(template, fields, frame_range)]
         if not frames:
             return None
 
         # return the range
         return (min(frames), max(frames))
 
-    def version_from_name(self, name):
+    def get_frame_range(self, asset):
         """
-        Try to determine file version from its name base on different regex patterns
+        Get the subset of frames that should be delivered for the sequence.
 
-        :returns: None or integer
+        Frame ranges given on the command line take precedence. Range set
+        for a particular asset wins over the range set for all assets.
+        If --cut flag was given shot cut in and cut out is used.
+
+        :returns: None to deliver all frames, otherwise (first, last)
         """
-        version_patterns = [
-            '([vV])(?P<version_number>[0-9]+)',  # v001, V00001
-            '([A-Za-z]+)_(?P<version_number>[0-9]+)'  # name_01
-        ]
+        names = [asset.name, asset.sg_data.get('code')]
+        entity = asset.sg_data.get('entity') or {}
+        names.append(entity.get('name'))
+
+        for name in names:
+            if name is not None and name in self.frame_ranges:
+                return self.frame_ranges[name]
 
-        # Return firs matched pattern in self.version_patterns list
-        for p in version_patterns:
-            result = re.finditer(p, name)
-            if result is not None:
-                # log.debug('Regex version result: %s', result.group('version_number'))
-                version = None
-                # We alway want to use version found at the and of the name
-                # e.g. for name like 'rvb300_match_30mlCamZv03_v006.fbx' we should return 6 not 3
-                for v in result:
-                    version = int(v.group('version_number'))
+        if None in self.frame_ranges:
+            return self.frame_ranges[None]
 
-                return version
+        if self.opt.cut_range:
+            cut_in = asset.sg_data.get('entity.Shot.sg_cut_in')
+            cut_out = asset.sg_data.get('entity.Shot.sg_cut_out')
+            if cut_in is not None and cut_out is not None:
+                return (int(cut_in), int(cut_out))
+            log.warning('Cut in and cut out are not set for %s' % asset.name)
 
         return None
 
+    def get_final_versions(self):
+        """
+        Index of final version numbers by entity id. It is built
+        once per run from the final versions of the delivery project
+
+        :returns: FinalVersionIndex
+        """
+        if self._final_versions is None:
+            self._final_versions = FinalVersionIndex(
+                self.sg_delivery.all_delivery_versions, self.version_patterns
+            )
+        return self._final_versions
+
     def get_final_version(self, asset):
         """
         According to EEP business logic the final delivery version should
@@ -434,51 +678,55 @@ class Consolidator(object):
         If this function failed to acquire the final version it will fall back
         to the asset version.
         """
-        try:
-            fin_ver_code = asset.extra_attrs['final_version']['code']
-        except Exception as e:
-            log.debug(
-                'Failed to retrieve eep final version from asset %s. %s'
-                % (asset.name, e)
-            )
-            return int(asset.version)
-
-        version_number = self.version_from_name(fin_ver_code)
+        entity = asset.sg_data.get('entity') or {}
+        version_number = self.get_final_versions().get(entity.get('id'))
 
         if version_number is None:
             return int(asset.version)
         else:
             return version_number
 
-        # result = re.search(r'(v)([0-9]+)', fin_ver_code)
-        # if result:
-        #     return int(result.groups()[1])
-        # else:
-        #     return int(asset.version)
-
-    def run(self):
+    def get_delivery_settings(self):
         """
-        Then app run in cmd mode this function gets run
+        Get configuration for the delivery type of this delivery
+        from the list of delivery types in the project configuration
         """
-
-        log.info('Consolidating %s' % self.sg_delivery.title)
-
-        # Get all delivery types listed in the project configuration
         dl_types = self._app.get_setting('delivery_types', [])
 
-        # Get configuration for the delivery type
         dl_settings = {}
         for t in dl_types:
             if t['name'] != self.sg_delivery.type:
                 continue
             dl_settings = t
 
-        # Gather all of the assets attached to this delivery
-        dl_assets = self.sg_delivery.get_assets()
-        delivery_due_date = self.sg_delivery.get_field('sg_due_date')
-        due_year, due_month, due_day = [int(i) for i in delivery_due_date.split('-')]
+        return dl_settings
+
+    def get_bandwidth_limiter(self):
+        """
+        Bandwidth cap from the command line, the delivery type or the
+        app settings, in this order. Command line cap applies at any time,
+        configured caps only during "bandwidth_limit_hours".
+
+        :returns: BandwidthLimiter, unlimited if no cap is set
+        """
+        if self.opt.bandwidth_limit is not None:
+            return BandwidthLimiter(int(self.opt.bandwidth_limit * 1048576))
+
+        dl_settings = self.get_delivery_settings()
+        limit = dl_settings.get(
+            'bandwidth_limit', self._app.get_setting('bandwidth_limit', 0)
+        )
+        hours = dl_settings.get(
+            'bandwidth_limit_hours', self._app.get_setting('bandwidth_limit_hours', '')
+        )
+
+        return BandwidthLimiter(int((limit or 0) * 1048576), hours)
 
-        # Asset filtering logic
+    def filter_assets(self, dl_assets):
+        """
+        Exclude assets from processing base on the shotgun type
+        and extension filters
+        """
         filtered_assets = []
         for asset in dl_assets:
             # Exclude asset by its shotgun file type specified in the filter
@@ -488,153 +736,678 @@ class Consolidator(object):
             if asset.extension.lower() in self.ext_filter:
                 continue
             filtered_assets.append(asset)
-        dl_assets = filtered_assets
+        return filtered_assets
 
-        asset_completed = []  # Hold asset that have been successfuly consolidated
+    def get_asset_files(self, asset, source_template, dl_template, fields, frames=None):
+        """
+        List every file of the asset along with its delivery path.
 
-        for asset in dl_assets:
+        Image sequence frames are resolved through the delivery template
+        one by one so the copy can be tracked frame by frame.
 
-            log.info('-'*79)
-            log.info('Consolidating %s' % asset.name)
+        :param fields: Delivery fields used to build the asset delivery path
+        :param frames: List of (frame, path) tuples to deliver for
+            image sequences. All frames on disk are used if not specified
+        :returns: List of (source, destination) path pairs
+        """
+        src_path = str(asset.path)
 
-            # Check if any of the existing template can be applied to this path
-            source_template = self.tk.template_from_path(str(asset.path))
+        if asset.type != 'ImageSequence':
+            return [(src_path, dl_template.apply_fields(fields))]
 
-            if source_template is None:
-                log.warning(
-                    'File %s does not match any existing path templates'
-                    % asset.path
-                )
-                continue
+        if frames is None:
+            src_fields = source_template.get_fields(src_path)
+            frames = self._find_sequence_frames(source_template, src_fields)
 
-            # Extract fields from current path
-            fields = source_template.get_fields(str(asset.path))
-
-            final_version = self.get_final_version(asset)
-
-            # Added extra fields that might be required by the template
-            fields.update({
-                'delivery_title': self.sg_delivery.title,
-                'version': final_version,
-                'height': asset.height,
-                'width': asset.width,
-                'YYYY': due_year,
-                'MM': due_month,
-                'DD': due_day
-            })
-
-            step = fields.get('Step', '')
-            if not step:
-                log.error('Step was not determine from the source template.')
-                continue
+        files = []
+        for frame, frame_path in frames:
+            frame_fields = source_template.get_fields(frame_path)
+            dst_fields = dict(fields)
+            for key in ['SEQ', 'eye']:
+                if key in frame_fields:
+                    dst_fields[key] = frame_fields[key]
+            files.append((frame_path, dl_template.apply_fields(dst_fields)))
 
-            # Get our final delivery template base on the asset type
-            if asset.type == 'ImageSequence':
-                
-                if 'output' in fields:
-                    dl_template_name = dl_settings['matte_delivery_template']
-                else:
-                    dl_template_name = dl_settings['dpx_delivery_template']
-
-                seq_width = dl_settings.get('sequence_width', False)
-                seq_height = dl_settings.get('sequence_height', False)
-
-                # Check resolution
-                if seq_width and seq_height:
-                    if seq_width != fields['width'] or seq_height != fields['height']:
-                        if self.opt.force:
-                            log.warning('Sequence resolution doesn not match %sx%s' % (seq_width, seq_height))
-                        else:
-                            log.error('Skipping. Sequence resolution doesn not match %sx%s' % (seq_width, seq_height))
-                            continue
-
-            elif asset.type == 'VideoFile':
-                dl_template_name = dl_settings['mov_delivery_template']
-            elif asset.type == 'ImageFile':
-                dl_template_name = dl_settings['img_delivery_template']
-                fields.update({'img_ext': asset.extension})
-            else:
-                log.error('Asset type %s is not supported!' % asset.type)
-                continue
+        return files
 
-            dl_template = self._app.get_template_by_name(dl_template_name)
+    def resolve_asset(self, asset, dl_settings, due_date):
+        """
+        Build delivery path for the asset and all of its files
 
-            if dl_template is None:
-                log.error(
-                    'Failed to retrieve value for the template name: %s'
-                    % dl_template_name
-                )
+        :param dl_settings: Delivery type configuration
+        :param due_date: Delivery due date as (year, month, day) tuple
+        :returns: CopyItem or None if the asset can not be delivered
+        """
+        due_year, due_month, due_day = due_date
+
+        # Check if any of the existing template can be applied to this path
+        source_template = self.tk.template_from_path(str(asset.path))
 
-            # Before passing this fields to the path constructor
-            # run a user defined hook to do custom manipulations with the fields
-            # This allows for custom per delivery type name customization
-            fields = self._app.execute_hook_method(
-                'hook_customize_fields', 'execute',
-                fields=fields, delivery=self.sg_delivery
+        if source_template is None:
+            self._fail(
+                asset,
+                'File %s does not match any existing path templates'
+                % asset.path
             )
+            return None
 
-            # HACK(Kirill): This is a hacky way to handle assets
-            # In order to handle it "Shotgun" way we need to create
-            # separate path templates for asset and shots
-            asset_name = fields.get('Asset', False)
-            if asset_name:
-                fields.update({'Shot': asset_name})
-
-            # Build the new path base on the delivery template
-            delivery_path = dl_template.apply_fields(fields)
-
-            # Do some integrity checks
-            #
-            # Check that file and its target template has the same type
-            dest_ext = os.path.splitext(delivery_path)[1].lstrip('.')
-            if asset.extension != dest_ext:
-                log.error(
-                    'Skipping %s. '
-                    'Delivery asset type "%s" does not match '
-                    'destination type "%s" defined by the template.'
-                    % (asset.name, asset.extension, dest_ext))
-                continue
+        # Extract fields from current path
+        fields = source_template.get_fields(str(asset.path))
+
+        final_version = self.get_final_version(asset)
+
+        # Added extra fields that might be required by the template
+        fields.update({
+            'delivery_title': self.sg_delivery.title,
+            'version': final_version,
+            'height': asset.height,
+            'width': asset.width,
+            'YYYY': due_year,
+            'MM': due_month,
+            'DD': due_day
+        })
+
+        step = fields.get('Step', '')
+        if not step:
+            self._fail(asset, 'Step was not determine from the source template.')
+            return None
 
-            if debug:
-                asset.copy(delivery_path, dry_run=True)
+        # Get our final delivery template base on the asset type
+        if asset.type == 'ImageSequence':
+
+            if 'output' in fields:
+                dl_template_name = dl_settings['matte_delivery_template']
             else:
-                # Copy asset to delivery location
-                asset.copy(delivery_path)
+                dl_template_name = dl_settings['dpx_delivery_template']
+
+            seq_width = dl_settings.get('sequence_width', False)
+            seq_height = dl_settings.get('sequence_height', False)
+
+            # Check resolution
+            if seq_width and seq_height:
+                if seq_width != fields['width'] or seq_height != fields['height']:
+                    if self.opt.force:
+                        log.warning('Sequence resolution doesn not match %sx%s' % (seq_width, seq_height))
+                    else:
+                        self._fail(asset, 'Skipping. Sequence resolution doesn not match %sx%s' % (seq_width, seq_height))
+                        return None
+
+        elif asset.type == 'VideoFile':
+            dl_template_name = dl_settings['mov_delivery_template']
+        elif asset.type == 'ImageFile':
+            dl_template_name = dl_settings['img_delivery_template']
+            fields.update({'img_ext': asset.extension})
+        else:
+            self._fail(asset, 'Asset type %s is not supported!' % asset.type)
+            return None
 
-            asset_completed.append(asset)
+        dl_template = self._app.get_template_by_name(dl_template_name)
 
-        # Output final summary log for the user
-        # 
-        asset_not_completed = list(set(dl_assets) - set(asset_completed))
-        
-        print ''
+        if dl_template is None:
+            self._fail(
+                asset,
+                'Failed to retrieve value for the template name: %s'
+                % dl_template_name
+            )
+            return None
 
-        if len(asset_completed) < len(dl_assets):
-            print 'WARNING! The following assets were not consolidated:'
-            for i, asset in enumerate(asset_not_completed):
-                print ''
-                print '    %s. %s' % (i+1, asset.name)
-            print ''          
-            print (
-              'Please review your consolidation log. '
-              'You might be able to force consolidation of this assets by running consolidator with -f flag.'
+        # Before passing this fields to the path constructor
+        # run a user defined hook to do custom manipulations with the fields
+        # This allows for custom per delivery type name customization
+        fields = self._app.execute_hook_method(
+            'hook_customize_fields', 'execute',
+            fields=fields, delivery=self.sg_delivery
+        )
+
+        # HACK(Kirill): This is a hacky way to handle assets
+        # In order to handle it "Shotgun" way we need to create
+        # separate path templates for asset and shots
+        asset_name = fields.get('Asset', False)
+        if asset_name:
+            fields.update({'Shot': asset_name})
+
+        # Build the new path base on the delivery template
+        delivery_path = dl_template.apply_fields(fields)
+
+        # Do some integrity checks
+        #
+        # Check that file and its target template has the same type
+        dest_ext = os.path.splitext(delivery_path)[1].lstrip('.')
+        if asset.extension != dest_ext:
+            self._fail(
+                asset,
+                'Skipping %s. '
+                'Delivery asset type "%s" does not match '
+                'destination type "%s" defined by the template.'
+                % (asset.name, asset.extension, dest_ext))
+            return None
+
+        frames = None
+        frame_range = None
+        if asset.type == 'ImageSequence':
+            frame_range = self.get_frame_range(asset)
+
+        if frame_range is not None:
+            first, last = frame_range
+            log.info('Delivering frames %s-%s of %s' % (first, last, asset.name))
+
+            src_fields = source_template.get_fields(str(asset.path))
+            frames = self._find_sequence_frames(source_template, src_fields, frame_range)
+
+            found = set(f for f, p in frames)
+            missing = [f for f in range(first, last + 1) if f not in found]
+            if missing:
+                message = '%s frames missing in %s-%s range, first missing frame is %s' % (
+                    len(missing), first, last, missing[0]
+                )
+                if self.opt.force:
+                    log.warning(message)
+                else:
+                    self._fail(asset, 'Skipping. %s' % message)
+                    return None
+
+        files = self.get_asset_files(asset, source_template, dl_template, fields, frames)
+        if not files:
+            self._fail(asset, 'No files found on disk for %s' % asset.name)
+            return None
+
+        return CopyItem(asset, delivery_path, files, frame_range)
+
+    def get_due_date(self):
+        """ :returns: Delivery due date as [year, month, day] list """
+        delivery_due_date = self.sg_delivery.get_field('sg_due_date')
+        return [int(i) for i in delivery_due_date.split('-')]
+
+    def open_archive(self, plan, dl_settings):
+        """
+        Open archive the delivery is streamed into if its delivery type
+        has "archive" format specified. The archive location is built from
+        "archive_delivery_template" using the delivery title and due date.
+
+        :returns: ArchiveWriter or None for regular folder deliveries
+        """
+        archive_format = dl_settings.get('archive')
+        if not archive_format:
+            return None
+
+        template_name = dl_settings.get('archive_delivery_template')
+        archive_template = self._app.get_template_by_name(template_name)
+
+        if archive_template is None:
+            raise TankError(
+                'Failed to retrieve value for the archive template name: %s'
+                % template_name
             )
+
+        due_year, due_month, due_day = self.get_due_date()
+        archive_path = archive_template.apply_fields({
+            'delivery_title': self.sg_delivery.title,
+            'YYYY': due_year,
+            'MM': due_month,
+            'DD': due_day
+        })
+
+        destinations = []
+        for item in plan:
+            destinations.extend(item.destinations)
+
+        return ArchiveWriter(
+            archive_path,
+            archive_format,
+            archive_root(archive_path, destinations),
+            workers=dl_settings.get('archive_workers'),
+            level=dl_settings.get('archive_level'),
+            limiter=self.limiter,
+            cancel_event=self._cancelled,
+            dry_run=bool(debug)
+        )
+
+    def build_plan(self):
+        """
+        Gather all of the assets attached to this delivery and resolve
+        them to their delivery locations before anything is copied
+
+        :returns: CopyPlan
+        """
+        dl_settings = self.get_delivery_settings()
+        due_date = self.get_due_date()
+
+        self.assets = self.filter_assets(self.sg_delivery.get_assets())
+
+        # Report final versions with unexpected codes before anything else
+        self.get_final_versions().report_unparsed(
+            (a.sg_data.get('entity') or {}).get('id') for a in self.assets
+        )
+
+        plan = CopyPlan()
+        for asset in self.assets:
+            if self.cancelled:
+                break
+            log.debug('Resolving delivery path for %s' % asset.name)
+            item = self.resolve_asset(asset, dl_settings, due_date)
+            if item is not None:
+                plan.append(item)
+
+        return plan
+
+    def copy_task(self, task):
+        """
+        Copy files of a single scheduler task to the delivery location.
+        This method is called from the scheduler worker threads.
+        """
+        item = task.item
+
+        with self._lock:
+            if item in self._failed:
+                return
+            if item not in self._remaining:
+                self._remaining[item] = len(item.files)
+                log.info('Consolidating %s' % item.name)
+                self._notify('asset_started', item)
+
+        for src, dst in task.files:
+
+            # Copier is also cancelled when the work queue claim was lost
+            if self.cancelled or self.copier.cancelled or item in self._failed:
+                return
+
+            try:
+                if self._archive is not None:
+                    size = self._archive.add(src, dst)
+                else:
+                    size = self.copier.copy(src, dst)
+            except CopyCancelled:
+                return
+            except (IOError, OSError) as e:
+                with self._lock:
+                    self._failed.add(item)
+                self._fail(item.asset, 'Failed to copy %s. %s' % (src, e))
+                if self._archive is not None:
+                    # Partially written member leaves the archive unusable
+                    log.error('Archive %s is incomplete, stopping.' % self._archive.path)
+                    self.cancel()
+                return
+
+            self._notify('file_copied', item, src, dst, size)
+
+            with self._lock:
+                self._bytes_copied += size
+                self._files_copied += 1
+                self._remaining[item] -= 1
+                done = self._remaining[item] == 0
+                if done:
+                    self._completed.append(item.asset)
+
+            if done:
+                self._notify('asset_completed', item)
+
+    def run(self):
+        """
+        Then app run in cmd mode this function gets run
+
+        :returns: List of assets that have been consolidated
+        """
+
+        log.info('Consolidating %s' % self.sg_delivery.title)
+
+        plan = self.build_plan()
+        self._archive = self.open_archive(plan, self.get_delivery_settings())
+
+        self.scheduler.stat_plan(plan, self.copier.metadata)
+
+        if self._archive is not None:
+            # Archive members are written one at a time in the plan order
+            tasks = build_tasks(plan, largest_first=False)
+            scheduler = Scheduler(1, initializer=self.scheduler.initializer)
         else:
-            print (
-                'All assets have been consolidated for "%s" delivery. Yay! :)'
+            tasks = build_tasks(plan)
+            scheduler = self.scheduler
+
+        log.info(
+            'Copying %s files, %.1f MB with %s workers, bandwidth %s'
+            % (plan.file_count, plan.size / 1048576.0, scheduler.workers, self.limiter.describe())
+        )
+        self._notify('run_started', plan)
+
+        start_time = time.time()
+        try:
+            if self._archive is None:
+                self.copier.make_tree(plan.destination_dirs, self.scheduler)
+            scheduler.run(tasks, self.copy_task, lambda: self.cancelled)
+        except Exception:
+            if self._archive is not None:
+                self._archive.close(abort=True)
+            raise
+        finally:
+            # Files that made it to the delivery get their permissions either way
+            self.copier.apply_metadata(self.scheduler)
+
+        elapsed = time.time() - start_time
+
+        # Keep the plan order in the summary
+        asset_completed = [i.asset for i in plan if i.asset in self._completed]
+
+        archive = self._archive
+        if archive is not None:
+            # Cancelled archive is incomplete, do not leave it for the vendor
+            archive.close(abort=self.cancelled)
+            if self.cancelled:
+                asset_completed = []
+            self._archive = None
+
+        if self.cancelled:
+            log.warning('Consolidation of %s was cancelled' % self.sg_delivery.title)
+
+        if self.opt.write_back and not debug and not self.cancelled:
+            self.write_back(plan, asset_completed, archive)
+
+        self.log_metrics(elapsed)
+
+        # Output final summary for the user
+        self._notify(
+            'run_throughput',
+            self._bytes_copied, elapsed, self.limiter, self.copier.metadata
+        )
+        self._notify('run_finished', self.assets, asset_completed, self.cancelled)
+
+        return asset_completed
+
+    def log_metrics(self, elapsed):
+        """ Log throughput and file system metadata operations of the run """
+        log.info(throughput_summary(self._bytes_copied, elapsed, self.limiter))
+
+        metadata = self.copier.metadata
+        log.info(
+            'Metadata operations: %s, %.1f per file'
+            % (metadata.describe(), metadata.total() / float(max(self._files_copied, 1)))
+        )
+
+    def write_back(self, plan, completed, archive=None):
+        """
+        Record delivered paths, sizes, checksums and status on Shotgun
+
+        :param archive: Closed ArchiveWriter of archive deliveries
+        """
+        write_back = WriteBack.from_app(self._app)
+        # Runs limited to some assets or frames do not represent the delivery
+        whole_delivery = not (
+            self.sg_type_filter or self.ext_filter or self.frame_ranges or self.opt.cut_range
+        )
+
+        requests = write_back.build_requests(
+            self.sg_delivery, plan, self.assets, completed,
+            self.copier.checksums, archive, whole_delivery
+        )
+
+        if not requests:
+            log.info('Shotgun is up to date for %s' % self.sg_delivery.title)
+            return
+
+        try:
+            write_back.commit(requests)
+        except Exception as e:
+            # Files are delivered at this point, do not hide the summary
+            log.error('Failed to record consolidation results on Shotgun. %s' % e)
+
+    def get_work_queue(self):
+        """
+        Work queue of this delivery on the shared file system. Queues live in
+        "work_queue_root" setting or in .consolidator folder of the project.
+        """
+        root = self._app.get_setting('work_queue_root', '')
+        if not root:
+            root = os.path.join(self.tk.project_path, '.consolidator')
+
+        return WorkQueue(
+            os.path.join(root, 'delivery_%s' % self.sg_delivery.id),
+            stale_timeout=self._app.get_setting('work_queue_stale_timeout', 300)
+        )
+
+    def queue_fingerprint(self):
+        """
+        Hash of everything the copy plan of a worker run is built from:
+        attached Versions and PublishedFiles, delivery type and the filters.
+        Queues built for a different fingerprint are out of date.
+        """
+        sg_data = self.sg_delivery.sg_data
+        data = {
+            'type': self.sg_delivery.type,
+            'versions': sorted(
+                v['id'] for v in sg_data.get('sg_versions') or []
+            ),
+            'published_files': sorted(
+                p['id'] for p in sg_data.get('published_file_sg_delivery_published_files') or []
+            ),
+            'sg_type_filter': sorted(self.sg_type_filter),
+            'ext_filter': sorted(self.ext_filter),
+            'frame_range': sorted(self.opt.frame_range or [], key=repr),
+            'cut_range': self.opt.cut_range,
+            'force': self.opt.force
+        }
+        return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def check_work_queue(self, queue):
+        """
+        Make sure an existing queue was built for the current delivery.
+        Call under the queue lock.
+
+        Finished queues of a changed delivery are rebuilt. Unfinished ones
+        fail loudly, other hosts may still be copying their shards.
+        """
+        manifest = queue.manifest()
+
+        if manifest.get('fingerprint') != self.queue_fingerprint():
+            if not queue.is_finished():
+                raise TankError(
+                    'Work queue %s was created for different contents of %s '
+                    'and is still in progress. Wait for the other workers '
+                    'or run one of them with --reset-queue.'
+                    % (queue.root, self.sg_delivery.title)
+                )
+            log.warning(
+                '%s changed since the last worker run, rebuilding the work queue'
                 % self.sg_delivery.title
             )
+            queue.reset()
 
+        elif queue.is_finished():
+            log.warning(
+                'Work queue of %s finished on %s, nothing is left to copy. '
+                'Use --reset-queue to consolidate the delivery again.'
+                % (self.sg_delivery.title, time.ctime(manifest['created']))
+            )
 
-def parse_arguments(args):
+    def create_work_queue(self, queue):
+        """ Resolve the plan and store it in the queue as shards """
+        if self.get_delivery_settings().get('archive'):
+            raise TankError(
+                'Archive delivery %s can not be consolidated by several workers'
+                % self.sg_delivery.title
+            )
+
+        plan = self.build_plan()
+        self.scheduler.stat_plan(plan, self.copier.metadata)
+
+        shard_size = self._app.get_setting('work_queue_shard_size', 10737418240)
+        planned = set(i.name for i in plan)
+
+        queue.create(
+            make_shards(plan, shard_size),
+            [a.name for a in self.assets],
+            [a.name for a in self.assets if a.name not in planned],
+            fingerprint=self.queue_fingerprint()
+        )
+
+    def copy_shard(self, queue, shard):
+        """
+        Copy all files of the claimed shard
+
+        :returns: Shard result dictionary, see WorkQueue.complete,
+            or None if another worker recovered the claim meanwhile
+        """
+        items = []
+        for data in shard['items']:
+            files = [tuple(f) for f in data['files']]
+            item = CopyItem(QueuedAsset(data['asset']), None, files)
+            item.sizes = data['sizes']
+            items.append(item)
+
+        # Set when the run is cancelled or the heartbeat finds the claim gone
+        shard_stopped = threading.Event()
+        self._shard_stopped = shard_stopped
+        if self.cancelled:
+            shard_stopped.set()
+        self.copier.cancel_event = shard_stopped
+
+        stop_heartbeat = queue.start_heartbeat(shard, lost=shard_stopped)
+        try:
+            self.copier.make_tree(CopyPlan(items).destination_dirs, self.scheduler)
+            self.scheduler.run(build_tasks(items), self.copy_task, shard_stopped.is_set)
+        finally:
+            self.copier.apply_metadata(self.scheduler)
+            stop_heartbeat.set()
+            self.copier.cancel_event = self._cancelled
+            self._shard_stopped = None
+
+        if shard_stopped.is_set() and not self.cancelled:
+            return None
+
+        failed = [i.name for i in items if i in self._failed]
+        incomplete = [
+            i.name for i in items
+            if i not in self._failed and self._remaining.get(i) != 0
+        ]
+
+        return {
+            'failed': failed,
+            'incomplete': incomplete,
+            'files': sum(len(i.files) for i in items),
+            'size': shard['size']
+        }
+
+    def run_worker(self):
+        """
+        Consolidate delivery together with other hosts.
+
+        The first worker resolves the plan and splits it into shards on
+        the shared file system. Every worker then claims shards until all
+        of them are done. Workers keep polling while other hosts are busy
+        so they can take over shards of a host that stopped responding.
+
+        :returns: List of assets that have been consolidated by all workers
+        """
+        log.info('Consolidating %s as a worker' % self.sg_delivery.title)
+
+        if self.opt.write_back:
+            # Checksums of files copied by other hosts are not available here
+            log.warning('Results are not recorded on Shotgun in worker mode')
+
+        queue = self.get_work_queue()
+
+        # Workers may copy the same shard after a claim was recovered,
+        # each of them writes its own partial files
+        self.copier.part_suffix = '.%s.part' % queue.worker_id
+
+        with queue.lock():
+            if self.opt.reset_queue:
+                queue.reset()
+            elif queue.exists():
+                self.check_work_queue(queue)
+            if not queue.exists():
+                self.create_work_queue(queue)
+
+        poll_interval = self._app.get_setting('work_queue_poll_interval', 10)
+        copy_time = 0.0
+
+        while not self.cancelled:
+
+            shard = queue.claim()
+
+            if shard is None:
+                queue.recover_stale()
+                if queue.is_finished():
+                    break
+                shard = queue.claim()
+
+            if shard is None:
+                # Other hosts are still working, wait in case one of them dies
+                self._cancelled.wait(poll_interval)
+                continue
+
+            start_time = time.time()
+            result = self.copy_shard(queue, shard)
+            copy_time += time.time() - start_time
+
+            if self.cancelled:
+                queue.release(shard)
+                break
+
+            if result is None:
+                log.warning(
+                    'Claim of %s was recovered by another worker, '
+                    'leaving the shard to it' % shard['id']
+                )
+                continue
+
+            queue.complete(shard, result)
+
+        assets, completed, finished = queue.summary()
+
+        if finished:
+            log.info('All shards of %s are done' % self.sg_delivery.title)
+
+        # Throughput is measured for this host only
+        self.log_metrics(copy_time)
+
+        # Output final summary merged from all workers
+        self._notify(
+            'run_throughput',
+            self._bytes_copied, copy_time, self.limiter, self.copier.metadata
+        )
+        self._notify('run_finished', assets, completed, self.cancelled)
+
+        return completed
+
+
+def frame_range(value):
+    """
+    Parse frame range command line argument. Accepted values are
+    FIRST-LAST for all sequences or NAME=FIRST-LAST for a single asset
+
+    :returns: (name, first, last) tuple. Name is None for all sequences
+    """
+    name = None
+    if '=' in value:
+        name, value = value.rsplit('=', 1)
+
+    match = re.match(r'^(-?[0-9]+)-(-?[0-9]+)$', value)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            'invalid frame range "%s", expected FIRST-LAST' % value
+        )
+
+    first, last = int(match.group(1)), int(match.group(2))
+    if first > last:
+        raise argparse.ArgumentTypeError(
+            'first frame of the range %s is greater than the last' % value
+        )
+
+    return (name, first, last)
+
+
+def get_parser():
+    """
+    Build consolidator argument parser. It is shared between
+    the command line and UI so both accept the same options
+    """
 
     parser = argparse.ArgumentParser(
         description="command line application that prepare production assets for delivery"
     )
     parser.add_argument(
-        '-id',
+        '-id', nargs='+', type=int,
         required=True,
-        help='shotgun delivery id',
+        help='shotgun delivery id, several deliveries are consolidated one after another',
     )
     parser.add_argument(
         '-stf', nargs='+', metavar='TYPE', dest='sg_type_filter',
@@ -645,8 +1418,56 @@ def parse_arguments(args):
         help='exclude assets from processing by its extension',
     )
 
+    parser.add_argument(
+        '-fr', nargs='+', metavar='RANGE', dest='frame_range', type=frame_range,
+        help='deliver only FIRST-LAST frames of sequences, '
+             'use NAME=FIRST-LAST to set range for a single version or shot',
+    )
+    parser.add_argument(
+        '--cut', action='store_true', dest='cut_range',
+        help='deliver only sequence frames between shot cut in and cut out',
+    )
+
+    parser.add_argument(
+        '--due-first', action='store_true', dest='due_first',
+        help='consolidate deliveries with the nearest due date first',
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, metavar='N', dest='workers',
+        help='number of files copied at the same time',
+    )
+
+    parser.add_argument(
+        '--limit', type=float, metavar='MB', dest='bandwidth_limit',
+        help='cap copy bandwidth to MB per second at any time of day, 0 lifts the configured cap',
+    )
+    parser.add_argument(
+        '--low-priority', action='store_true', dest='low_priority',
+        help='copy with low cpu and io priority',
+    )
+
+    parser.add_argument(
+        '--write-back', action='store_true', dest='write_back',
+        help='record delivered paths, sizes, checksums and status on shotgun',
+    )
+    parser.add_argument(
+        '--worker', action='store_true',
+        help='consolidate together with other hosts running in worker mode',
+    )
+    parser.add_argument(
+        '--reset-queue', action='store_true', dest='reset_queue',
+        help='discard work queue of the previous worker run, use on one host only',
+    )
+
     parser.add_argument('--force', '-f', help='force consolidation for assets with warnings', action='store_true')
 
+    return parser
+
+
+def parse_arguments(args):
+
+    parser = get_parser()
+
     # No arguments provided
     # Print help and exit
     if len(sys.argv) == 2:
@@ -667,8 +1488,34 @@ def run(app, *args):
 
     app_args = parse_arguments(args)
 
+    # A failed delivery does not stop the others, failures are reported last
+    failed = []
+
     # Create Delivery object that represent a single delivery item on SG
-    sg_delivery = Delivery(app.shotgun, app_args.id)
+    sg_deliveries = []
+    for i in app_args.id:
+        try:
+            sg_deliveries.append(Delivery(app.shotgun, i, write_back=app_args.write_back))
+        except Exception:
+            log.exception('Failed to load delivery %s' % i)
+            failed.append(i)
+
+    if app_args.due_first:
+        sg_deliveries.sort(key=lambda d: d.get_field('sg_due_date'))
 
-    c = Consolidator(app, sg_delivery, app_args)
-    c.run()
+    for sg_delivery in sg_deliveries:
+        try:
+            c = Consolidator(app, sg_delivery, app_args)
+            if app_args.worker:
+                c.run_worker()
+            else:
+                c.run()
+        except Exception:
+            log.exception('Consolidation of delivery %s failed' % sg_delivery.id)
+            failed.append(sg_delivery.id)
+
+    if failed:
+        raise TankError(
+            'Consolidation failed for deliveries: %s'
+            % ', '.join(str(i) for i in sorted(failed))
+        )
@@ -0,0 +1,524 @@
+import os
+import stat
+import time
+import errno
+import hashlib
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from tank.errors import TankError
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+# Errors that are worth retrying on network file systems
+TRANSIENT_ERRORS = set([
+    errno.EIO,
+    errno.EAGAIN,
+    errno.EINTR,
+    errno.EBUSY,
+    errno.ETIMEDOUT,
+    errno.ESTALE,
+    errno.ECONNRESET,
+    errno.ECONNABORTED,
+    errno.EHOSTUNREACH,
+    errno.ENETRESET,
+])
+
+# linux/falloc.h, reserve space without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+
+_fallocate = None
+
+
+def _get_fallocate():
+    """ Lazy load fallocate from libc, returns False if it is not available """
+    global _fallocate
+
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _fallocate = libc.fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            _fallocate.restype = ctypes.c_int
+        except (OSError, AttributeError, TypeError):
+            _fallocate = False
+
+    return _fallocate
+
+
+class CopyCancelled(Exception):
+    """ Raised by copies that stopped because the run was cancelled """
+
+
+def _parse_mode(value):
+    """ Octal permission string such as "0644" to int, None if empty """
+    if not value:
+        return None
+    return int(str(value), 8)
+
+
+def is_transient(error):
+    """
+    Check if the IO error is likely to go away if the operation is retried.
+    Errors without errno (e.g. source that changed size during the copy)
+    are not retried.
+    """
+    return error.errno in TRANSIENT_ERRORS
+
+
+class MetadataCounter(object):
+    """
+    Thread safe count of file system metadata operations by name.
+    On network file systems every one of them is a round trip to the server
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def describe(self):
+        """ Human readable counts for the run summary """
+        return ', '.join(
+            '%s %s' % (name, count) for name, count in sorted(self.counts.items())
+        ) or 'none'
+
+
+class Copier(object):
+    """
+    Copy files to delivery location safely over flaky network mounts.
+
+        - Files are written to a temporary .part file and renamed into place
+          once the copy is complete, so a partial file never has the final name
+        - Transient IO errors are retried with exponential backoff
+        - Large files resume from the last verified offset of the .part file
+          instead of starting from the first byte
+        - Data is copied in large chunks and destination space can be
+          preallocated up front to keep writes sequential
+        - Checksum of the copied data can be computed on the fly,
+          results are kept in self.checksums by destination path
+        - Copy bandwidth can be capped with a BandwidthLimiter shared
+          by all workers
+        - Destination directories are created up front in one pass, see
+          make_tree. Permissions and ownership are set in batches once the
+          data is copied, see apply_metadata. Metadata operations are
+          counted in self.metadata
+    """
+
+    def __init__(self, buffer_size=8388608, retries=5, retry_delay=1.0,
+                 resume_size=268435456, preallocate=False, checksum=None,
+                 limiter=None, file_mode=None, dir_mode=None, group=None,
+                 metadata_batch_size=256, cancel_event=None, dry_run=False):
+        """
+        :param buffer_size: Size of a single read/write chunk in bytes
+        :param retries: Number of times the copy is retried on transient errors
+        :param retry_delay: Delay before the first retry in seconds.
+            The delay doubles with every next attempt
+        :param resume_size: Files of this size or bigger resume partial copies
+        :param preallocate: Reserve destination disk space before writing
+        :param checksum: Name of hashlib algorithm used to checksum
+            copied files, e.g. "md5". No checksum is computed if None
+        :param limiter: BandwidthLimiter every copied chunk goes through
+        :param file_mode: Permission bits of copied files.
+            Source file permissions are kept if None
+        :param dir_mode: Permission bits of created directories.
+            Left to the umask if None
+        :param group: Group name copied files and created directories
+            belong to. Left to the file system if empty
+        :param metadata_batch_size: Number of files a single worker sets
+            permissions and ownership of at once
+        :param cancel_event: threading.Event that stops running copies
+            between chunks and cuts retry delays short once it is set
+        :param dry_run: Only log the operations without touching the disk
+        """
+        # Partial copies are written to destination + part_suffix. Workers
+        # sharing a delivery use their own suffix, see Consolidator.run_worker
+        self.part_suffix = '.part'
+
+        self.buffer_size = buffer_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.resume_size = resume_size
+        self.preallocate = preallocate
+        self.checksum = checksum
+        self.limiter = limiter
+        self.file_mode = file_mode
+        self.dir_mode = dir_mode
+        self.gid = self._group_id(group)
+        self.metadata_batch_size = metadata_batch_size
+        self.cancel_event = cancel_event
+        self.dry_run = dry_run
+        self.checksums = {}
+        self.metadata = MetadataCounter()
+
+        self.dirs = set()  # Destination directories known to exist
+        self._created_dirs = []  # Directories created by make_tree
+        self._modes = {}  # Source permissions of copied files by destination
+
+    @classmethod
+    def from_app(cls, app, checksum=None, limiter=None, cancel_event=None, dry_run=False):
+        """ Create copier configured by the app settings """
+        return cls(
+            buffer_size=app.get_setting('copy_buffer_size', 8388608),
+            retries=app.get_setting('copy_retries', 5),
+            retry_delay=app.get_setting('copy_retry_delay', 1.0),
+            resume_size=app.get_setting('copy_resume_size', 268435456),
+            preallocate=app.get_setting('copy_preallocate', False),
+            checksum=checksum,
+            limiter=limiter,
+            file_mode=_parse_mode(app.get_setting('delivery_file_mode', '')),
+            dir_mode=_parse_mode(app.get_setting('delivery_dir_mode', '')),
+            group=app.get_setting('delivery_group', ''),
+            cancel_event=cancel_event,
+            dry_run=dry_run
+        )
+
+    def _group_id(self, group):
+        """ Look up id of the group name, None if no group is set """
+        if not group:
+            return None
+        try:
+            import grp
+        except ImportError:
+            log.warning('Setting delivery group is not supported on this platform')
+            return None
+        try:
+            return grp.getgrnam(group).gr_gid
+        except KeyError:
+            raise TankError('Delivery group %s does not exist' % group)
+
+    def make_tree(self, dirs, scheduler=None):
+        """
+        Create destination directories before anything is copied.
+
+        Directories are deduplicated and only the deepest ones are created,
+        their parents come along. Each of them costs a single mkdir when the
+        parent exists, no stat calls are made up front.
+
+        :param dirs: Iterable of destination directories
+        :param scheduler: Scheduler to create the directories in parallel
+        """
+        dirs = set(d for d in dirs if d not in self.dirs)
+        if not dirs:
+            return
+
+        # Ancestors of other directories are created by their children
+        parents = set()
+        for d in dirs:
+            parent = os.path.dirname(d)
+            while parent not in parents and parent != os.path.dirname(parent):
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+
+        leaves = sorted(dirs - parents)
+
+        if self.dry_run:
+            log.debug('Create %s destination directories' % len(leaves))
+            return
+
+        if scheduler is not None:
+            created = scheduler.map(self._try_make_dir, leaves)
+        else:
+            created = [self._try_make_dir(d) for d in leaves]
+
+        for c in created:
+            self._created_dirs.extend(c or [])
+
+        if None in created:
+            # Copies into directories that failed report the error per asset
+            self.dirs.update(d for d, c in zip(leaves, created) if c is not None)
+        else:
+            self.dirs.update(dirs)
+            self.dirs.update(parents)
+
+        log.debug(
+            'Created %s directories for %s destinations'
+            % (sum(len(c or []) for c in created), len(leaves))
+        )
+
+    def _try_make_dir(self, path):
+        """ :returns: List of created directories or None on error """
+        try:
+            return self._make_dir(path)
+        except OSError as e:
+            log.debug('Failed to create %s. %s' % (path, e))
+            return None
+
+    def _make_dir(self, path):
+        """
+        Create directory and its missing parents. Parents are created one
+        level at a time, so every directory this call created is known and
+        gets its permissions in apply_metadata.
+
+        :returns: List of directories that were created, parents first
+        """
+        created = []
+        missing = []  # Directories below the first one that could be created
+        current = path
+
+        while True:
+            self.metadata.add('mkdir')
+            try:
+                os.mkdir(current)
+                created.append(current)
+                break
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    break
+                parent = os.path.dirname(current)
+                if e.errno != errno.ENOENT or parent == current:
+                    raise
+            missing.append(current)
+            current = parent
+
+        for d in reversed(missing):
+            self.metadata.add('mkdir')
+            try:
+                os.mkdir(d)
+                created.append(d)
+            except OSError as e:
+                # Another worker was faster
+                if e.errno != errno.EEXIST:
+                    raise
+
+        return created
+
+    def apply_metadata(self, scheduler=None):
+        """
+        Set permissions and ownership of files copied since the last call
+        and of the directories make_tree created. Paths are split into
+        batches of metadata_batch_size handled by the scheduler workers.
+        Failures are logged, the data is delivered at this point anyway.
+
+        :param scheduler: Scheduler to process the batches in parallel
+        """
+        paths = []
+        for dst, mode in sorted(self._modes.items()):
+            if self.file_mode is not None:
+                mode = self.file_mode
+            paths.append((dst, mode))
+        self._modes = {}
+
+        if self.dir_mode is not None or self.gid is not None:
+            paths.extend((d, self.dir_mode) for d in self._created_dirs)
+        self._created_dirs = []
+
+        if not paths:
+            return
+
+        size = self.metadata_batch_size
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+
+        if scheduler is not None:
+            scheduler.map(self._apply_batch, batches)
+        else:
+            for batch in batches:
+                self._apply_batch(batch)
+
+    def _apply_batch(self, batch):
+        """ Set permissions and ownership of (path, mode) pairs """
+        for path, mode in batch:
+            try:
+                if mode is not None:
+                    self.metadata.add('chmod')
+                    os.chmod(path, mode)
+                if self.gid is not None:
+                    self.metadata.add('chown')
+                    os.chown(path, -1, self.gid)
+            except OSError as e:
+                log.warning('Failed to set permissions of %s. %s' % (path, e))
+
+    def copy(self, src, dst):
+        """
+        Copy a single file to its delivery location creating
+        missing destination directories on the way.
+        Size, times and permissions are taken from the opened source,
+        the plan may have been stat'ed long before the copy starts
+
+        :param src: Source file path
+        :param dst: Destination file path
+        :returns: Number of bytes copied
+        """
+        if self.dry_run:
+            log.debug('Copy %s -> %s' % (src, dst))
+            self.metadata.add('stat')
+            return os.path.getsize(src)
+
+        self._check_cancelled(src)
+
+        # Directories are normally created up front by make_tree
+        dst_dir = os.path.dirname(dst)
+        if dst_dir not in self.dirs:
+            self._created_dirs.extend(self._make_dir(dst_dir))
+            self.dirs.add(dst_dir)
+
+        tmp = dst + self.part_suffix
+        attempt = 0
+
+        while True:
+            try:
+                digest, src_stat = self._copy_data(src, tmp)
+                break
+            except (IOError, OSError) as e:
+                if not is_transient(e) or attempt >= self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                log.warning(
+                    'Failed to copy %s, retrying in %.1fs (%s/%s). %s'
+                    % (src, delay, attempt, self.retries, e)
+                )
+                self._wait(delay)
+                self._check_cancelled(src)
+
+        # Permissions are set later in a batch, see apply_metadata
+        self.metadata.add('utime')
+        os.utime(tmp, (src_stat.st_atime, src_stat.st_mtime))
+
+        # Windows can not rename over an existing file
+        if os.name == 'nt':
+            self.metadata.add('stat')
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        self.metadata.add('rename')
+        os.rename(tmp, dst)
+
+        self._modes[dst] = stat.S_IMODE(src_stat.st_mode)
+
+        if digest is not None:
+            self.checksums[dst] = digest
+
+        return src_stat.st_size
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def _check_cancelled(self, src):
+        if self.cancelled:
+            raise CopyCancelled('Copy of %s was cancelled' % src)
+
+    def _wait(self, delay):
+        """ Sleep before the next retry unless the run gets cancelled """
+        if self.cancel_event is not None:
+            self.cancel_event.wait(delay)
+        else:
+            time.sleep(delay)
+
+    def _resume_offset(self, fsrc, tmp, size):
+        """
+        Find the offset the copy can continue from.
+
+        The tail of the partial file is compared with the source before
+        it is trusted, anything that does not match is copied again.
+
+        :param fsrc: Source file object opened for reading
+        :returns: Number of bytes of the partial file that can be kept
+        """
+        if size < self.resume_size:
+            return 0
+
+        self.metadata.add('stat')
+        try:
+            offset = os.path.getsize(tmp)
+        except OSError:
+            return 0
+        if offset == 0 or offset > size:
+            return 0
+
+        check_size = min(self.buffer_size, offset)
+        fsrc.seek(offset - check_size)
+        src_tail = fsrc.read(check_size)
+        with open(tmp, 'rb') as ftmp:
+            ftmp.seek(offset - check_size)
+            tmp_tail = ftmp.read(check_size)
+
+        if src_tail != tmp_tail:
+            log.warning('Partial copy of %s does not match the source, starting over' % fsrc.name)
+            return 0
+
+        log.info('Resuming copy of %s from %s bytes' % (fsrc.name, offset))
+        return offset
+
+    def _preallocate(self, fd, size):
+        """ Reserve disk space for the file if the platform supports it """
+        fallocate = _get_fallocate()
+        if not fallocate:
+            return
+        if fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+            # Not supported by many network file systems, it is just a hint
+            log.debug(
+                'Preallocation is not available for %s. %s'
+                % (fd, os.strerror(ctypes.get_errno()))
+            )
+
+    def _copy_data(self, src, tmp):
+        """
+        Copy source data into the temporary file in chunks
+
+        :returns: Tuple of (digest, stat). Digest is the hex digest of the data
+            if checksum is enabled, otherwise None. Stat is os.fstat result
+            of the source taken when it was opened
+        """
+        with open(src, 'rb') as fsrc:
+            self.metadata.add('fstat')
+            src_stat = os.fstat(fsrc.fileno())
+            size = src_stat.st_size
+
+            offset = self._resume_offset(fsrc, tmp, size)
+            mode = 'r+b' if offset else 'wb'
+
+            digest = None
+            if self.checksum:
+                digest = hashlib.new(self.checksum)
+                if offset:
+                    # Data kept from the previous attempt is part of the checksum too
+                    with open(tmp, 'rb') as ftmp:
+                        remaining = offset
+                        while remaining:
+                            buf = ftmp.read(min(self.buffer_size, remaining))
+                            if not buf:
+                                break
+                            digest.update(buf)
+                            remaining -= len(buf)
+
+            with open(tmp, mode) as fdst:
+                if self.preallocate and size:
+                    self._preallocate(fdst.fileno(), size)
+
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                fdst.truncate()
+
+                while True:
+                    buf = fsrc.read(self.buffer_size)
+                    if not buf:
+                        break
+                    self._check_cancelled(src)
+                    if self.limiter is not None:
+                        self.limiter.consume(len(buf), self.cancel_event)
+                    fdst.write(buf)
+                    if digest is not None:
+                        digest.update(buf)
+
+                # Position tells the size without asking the file server
+                copied = fdst.tell()
+
+        if copied != size:
+            # Source is still being written, retrying would not help
+            raise IOError(
+                'Copied %s bytes of %s bytes from %s, the source changed during the copy'
+                % (copied, size, src)
+            )
+
+        if digest is not None:
+            return digest.hexdigest(), src_stat
+        return None, src_stat
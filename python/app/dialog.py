@@ -1,22 +1,24 @@
 # Copyright (c) 2013 Shotgun Software Inc.
-# 
+#
 # CONFIDENTIAL AND PROPRIETARY
-# 
-# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit 
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
 # Source Code License included in this distribution package. See LICENSE.
-# By accessing, using, copying or modifying this work you indicate your 
-# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights 
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 import sgtk
 import os
 import sys
+import time
 import threading
 
 # by importing QT from sgtk rather than directly, we ensure that
 # the code will be compatible with both PySide and PyQt.
 from sgtk.platform.qt import QtCore, QtGui
 from .ui.dialog import Ui_Dialog
+from . import consolidator
 
 def show_dialog(app_instance):
     """
@@ -24,40 +26,267 @@ def show_dialog(app_instance):
     """
     # in order to handle UIs seamlessly, each toolkit engine has methods for launching
     # different types of windows. By using these methods, your windows will be correctly
-    # decorated and handled in a consistent fashion by the system. 
-    
+    # decorated and handled in a consistent fashion by the system.
+
     # we pass the dialog class to this method and leave the actual construction
     # to be carried out by toolkit.
-    app_instance.engine.show_dialog("Starter Template App...", app_instance, AppDialog)
-    
+    app_instance.engine.show_dialog("Consolidator", app_instance, AppDialog)
+
+
+class SignalReporter(consolidator.ProgressReporter):
+    """
+    Forward consolidator progress to the worker thread Qt signals.
+    Signals are emitted from the worker thread and delivered to the dialog
+    through the Qt event loop, so the host application never blocks on them.
+    """
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    def run_started(self, plan):
+        self._worker.run_started.emit(len(plan), plan.file_count)
+
+    def asset_started(self, item):
+        self._worker.asset_started.emit(item.name, len(item.files))
+
+    def file_copied(self, item, src, dst, size):
+        self._worker.file_copied.emit(item.name, size)
+
+    def asset_failed(self, asset, message):
+        self._worker.asset_failed.emit(asset.name, message)
+
+    def run_finished(self, assets, completed, cancelled):
+        self._worker.run_finished.emit(len(assets), len(completed), cancelled)
+
+
+class ConsolidatorWorker(QtCore.QThread):
+    """
+    Run Consolidator for a single delivery in a background thread
+    """
+
+    run_started = QtCore.Signal(int, int)  # asset count, file count
+    asset_started = QtCore.Signal(str, int)  # asset name, file count
+    file_copied = QtCore.Signal(str, object)  # asset name, bytes copied, may exceed 32 bit int
+    asset_failed = QtCore.Signal(str, str)  # asset name, error message
+    run_finished = QtCore.Signal(int, int, bool)  # assets, completed, cancelled
+    error = QtCore.Signal(str)
+
+    def __init__(self, app, options, parent=None):
+        """
+        :param app: Shotgun Toolkit application instance
+        :param options: Consolidator options, see consolidator.get_parser
+        """
+        QtCore.QThread.__init__(self, parent)
+        self._app = app
+        self._options = options
+        self._consolidator = None
+        self._cancel_requested = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """ Ask the running consolidator to stop after the current file """
+        with self._lock:
+            self._cancel_requested = True
+            if self._consolidator is not None:
+                self._consolidator.cancel()
+
+    def run(self):
+        try:
+            sg_delivery = consolidator.Delivery(
+                self._app.shotgun, self._options.id[0],
+                write_back=self._options.write_back
+            )
+
+            with self._lock:
+                self._consolidator = consolidator.Consolidator(
+                    self._app, sg_delivery, self._options,
+                    reporter=SignalReporter(self)
+                )
+                if self._cancel_requested:
+                    self._consolidator.cancel()
+
+            self._consolidator.run()
+        except Exception as e:
+            self._app.log_exception('Consolidation failed')
+            self.error.emit(str(e))
 
 
 class AppDialog(QtGui.QWidget):
     """
     Main application dialog window
     """
-    
+
     def __init__(self):
         """
         Constructor
         """
         # first, call the base class and let it do its thing.
         QtGui.QWidget.__init__(self)
-        
+
         # now load in the UI that was created in the UI designer
-        self.ui = Ui_Dialog() 
+        self.ui = Ui_Dialog()
         self.ui.setupUi(self)
-        
+
         # most of the useful accessors are available through the Application class instance
         # it is often handy to keep a reference to this. You can get it via the following method:
         self._app = sgtk.platform.current_bundle()
-        
+
         # via the self._app handle we can for example access:
         # - The engine, via self._app.engine
         # - A Shotgun API instance, via self._app.shotgun
-        # - A tk API instance, via self._app.tk 
-        
-        # lastly, set up our very basic UI
+        # - A tk API instance, via self._app.tk
+
         self.ui.context.setText("Current Context: %s" % self._app.context)
-        
-        
+
+        self._worker = None
+        self._close_requested = False
+        self._start_time = None
+        self._bytes_copied = 0
+
+        # Assets are copied in parallel, the asset progress
+        # bar follows the asset that was started last
+        self._current_asset = None
+        self._asset_files_copied = {}
+
+        self.ui.run_button.clicked.connect(self._on_run)
+        self.ui.cancel_button.clicked.connect(self._on_cancel)
+
+        self._load_deliveries()
+
+    def _load_deliveries(self):
+        """ Populate delivery selector with the project deliveries """
+        filters = [['project', 'is', self._app.context.project]]
+        fields = ['title', 'sg_delivery_type', 'sg_due_date']
+        order = [{'field_name': 'sg_due_date', 'direction': 'desc'}]
+        deliveries = self._app.shotgun.find('Delivery', filters, fields, order)
+
+        for d in deliveries:
+            label = '%s  [%s, due %s]' % (
+                d['title'], d['sg_delivery_type'], d['sg_due_date']
+            )
+            self.ui.delivery_combo.addItem(label, d['id'])
+
+    def _get_options(self):
+        """
+        Build consolidator options out of the dialog widgets. Only the
+        delivery id goes through the parser, which would exit the host
+        application on text it does not accept
+        """
+        index = self.ui.delivery_combo.currentIndex()
+        delivery_id = int(self.ui.delivery_combo.itemData(index))
+        options = consolidator.get_parser().parse_args(args=['-id', str(delivery_id)])
+
+        sg_types = []
+        if self.ui.exclude_versions.isChecked():
+            sg_types.append('Version')
+        if self.ui.exclude_published_files.isChecked():
+            sg_types.append('PublishedFile')
+        options.sg_type_filter = sg_types or None
+
+        extensions = self.ui.extension_filter.text().replace(',', ' ').split()
+        extensions = [i.lstrip('.') for i in extensions if i.lstrip('.')]
+        options.extension_filter = extensions or None
+
+        options.cut_range = self.ui.cut_range.isChecked()
+        options.force = self.ui.force.isChecked()
+        options.write_back = self.ui.write_back.isChecked()
+
+        return options
+
+    def _set_running(self, running):
+        self.ui.delivery_group.setEnabled(not running)
+        self.ui.run_button.setEnabled(not running)
+        self.ui.cancel_button.setEnabled(running)
+
+    def _on_run(self):
+        if self.ui.delivery_combo.count() == 0:
+            return
+
+        self.ui.errors.clear()
+        self.ui.asset_progress.setValue(0)
+        self.ui.total_progress.setValue(0)
+        self.ui.current_asset.setText('Gathering delivery assets...')
+        self.ui.throughput.setText('')
+        self._bytes_copied = 0
+        self._start_time = time.time()
+        self._current_asset = None
+        self._asset_files_copied = {}
+
+        self._worker = ConsolidatorWorker(self._app, self._get_options(), self)
+        self._worker.run_started.connect(self._on_run_started)
+        self._worker.asset_started.connect(self._on_asset_started)
+        self._worker.file_copied.connect(self._on_file_copied)
+        self._worker.asset_failed.connect(self._on_asset_failed)
+        self._worker.run_finished.connect(self._on_run_finished)
+        self._worker.error.connect(self._on_error)
+        self._worker.finished.connect(self._on_worker_finished)
+
+        self._set_running(True)
+        self._worker.start()
+
+    def _on_cancel(self):
+        if self._worker is None:
+            return
+        self.ui.cancel_button.setEnabled(False)
+        self.ui.current_asset.setText('Cancelling...')
+        self._worker.cancel()
+
+    def _on_run_started(self, asset_count, file_count):
+        self.ui.total_progress.setRange(0, max(file_count, 1))
+        self.ui.total_progress.setValue(0)
+        self.ui.total_progress.setFormat('%%v / %s files' % file_count)
+
+    def _on_asset_started(self, name, file_count):
+        self._current_asset = name
+        self._asset_files_copied[name] = 0
+        self.ui.current_asset.setText(name)
+        self.ui.asset_progress.setRange(0, max(file_count, 1))
+        self.ui.asset_progress.setValue(0)
+        self.ui.asset_progress.setFormat('%%v / %s frames' % file_count)
+
+    def _on_file_copied(self, name, size):
+        self._asset_files_copied[name] = self._asset_files_copied.get(name, 0) + 1
+        if name == self._current_asset:
+            self.ui.asset_progress.setValue(self._asset_files_copied[name])
+        self.ui.total_progress.setValue(self.ui.total_progress.value() + 1)
+
+        self._bytes_copied += size
+        elapsed = max(time.time() - self._start_time, 0.001)
+        self.ui.throughput.setText(
+            '%.1f MB copied, %.1f MB/s'
+            % (self._bytes_copied / 1048576.0, self._bytes_copied / 1048576.0 / elapsed)
+        )
+
+    def _on_asset_failed(self, name, message):
+        self.ui.errors.addItem('%s: %s' % (name, message))
+
+    def _on_run_finished(self, asset_count, completed_count, cancelled):
+        if cancelled:
+            status = 'Cancelled. %s of %s assets consolidated.'
+        elif completed_count < asset_count:
+            status = 'Finished with errors. %s of %s assets consolidated.'
+        else:
+            status = 'Done. %s of %s assets consolidated.'
+        self.ui.current_asset.setText(status % (completed_count, asset_count))
+
+    def _on_error(self, message):
+        self.ui.current_asset.setText('Consolidation failed.')
+        self.ui.errors.addItem(message)
+
+    def _on_worker_finished(self):
+        self._worker = None
+        self._set_running(False)
+        if self._close_requested:
+            self.close()
+
+    def closeEvent(self, event):
+        """
+        Stop running consolidation before the dialog goes away. The dialog
+        stays open until the worker finished, so the UI is not blocked
+        """
+        if self._worker is not None:
+            self._close_requested = True
+            self._on_cancel()
+            event.ignore()
+            return
+        event.accept()
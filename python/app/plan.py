@@ -0,0 +1,90 @@
+import os
+
+
+class CopyItem(object):
+    """
+    This class represent a single delivery asset resolved to its final
+    delivery location. It holds every file that has to be copied for this asset
+    so the consolidator can report progress and schedule the work up front
+    """
+
+    def __init__(self, asset, delivery_path, files, frame_range=None):
+        """
+        :param asset: Asset object this item was resolved from
+        :param delivery_path: Delivery path built from the delivery template
+        :param files: List of (source, destination) file path pairs
+        :param frame_range: (first, last) frames delivered for sequences
+            or None if all frames are delivered
+        """
+        self.asset = asset
+        self.delivery_path = delivery_path
+        self.files = files
+        self.frame_range = frame_range
+        self.sizes = None  # Source file sizes, see Scheduler.stat_plan
+
+    def __repr__(self):
+        return '<CopyItem %s (%s files)>' % (self.name, len(self.files))
+
+    @property
+    def name(self):
+        return self.asset.name
+
+    @property
+    def size(self):
+        """ Total size of the item source files in bytes """
+        return sum(self.sizes or [])
+
+    @property
+    def destinations(self):
+        return [dst for src, dst in self.files]
+
+    @property
+    def destination_dirs(self):
+        """ Unique list of directories this item will copy files into """
+        dirs = []
+        seen = set()
+        for dst in self.destinations:
+            d = os.path.dirname(dst)
+            if d not in seen:
+                seen.add(d)
+                dirs.append(d)
+        return dirs
+
+
+class CopyPlan(object):
+    """
+    Resolved list of everything that will be delivered by a single
+    consolidator run
+    """
+
+    def __init__(self, items=None):
+        self.items = items or []
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, item):
+        self.items.append(item)
+
+    @property
+    def file_count(self):
+        return sum(len(i.files) for i in self.items)
+
+    @property
+    def size(self):
+        return sum(i.size for i in self.items)
+
+    @property
+    def destination_dirs(self):
+        """ Unique list of directories the whole plan copies files into """
+        dirs = []
+        seen = set()
+        for item in self.items:
+            for d in item.destination_dirs:
+                if d not in seen:
+                    seen.add(d)
+                    dirs.append(d)
+        return dirs
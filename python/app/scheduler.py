@@ -0,0 +1,181 @@
+import os
+import logging
+import threading
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+
+class CopyTask(object):
+    """
+    Unit of work handed to a single copy worker. It is either one big file
+    or a batch of small files that belong to the same CopyItem
+    """
+
+    def __init__(self, item, files, sizes):
+        """
+        :param item: CopyItem the files belong to
+        :param files: List of (source, destination) file path pairs
+        :param sizes: Sizes of the source files in bytes
+        """
+        self.item = item
+        self.files = files
+        self.sizes = sizes
+        self.size = sum(sizes)
+
+    def __repr__(self):
+        return '<CopyTask %s (%s files, %s bytes)>' % (self.item.name, len(self.files), self.size)
+
+
+def file_stat(path):
+    """ os.stat result of the file or None if it can not be accessed """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def build_tasks(plan, batch_bytes=67108864, batch_files=64, largest_first=True):
+    """
+    Split the plan into copy tasks.
+
+    Files of at least batch_bytes get a task of their own. Smaller files of
+    the same item are batched together until the batch reaches batch_bytes
+    or batch_files, so a frame sequence does not cost a task per frame.
+
+    Every item needs source sizes, see Scheduler.stat_plan
+
+    :param largest_first: Order tasks by size so the biggest files start
+        first and small batches fill in the gaps at the end of the run.
+        Otherwise the plan order is kept
+    :returns: List of CopyTask
+    """
+    tasks = []
+
+    for item in plan:
+        batch = []
+        batch_sizes = []
+
+        for (src, dst), size in zip(item.files, item.sizes):
+            if size >= batch_bytes:
+                tasks.append(CopyTask(item, [(src, dst)], [size]))
+                continue
+
+            batch.append((src, dst))
+            batch_sizes.append(size)
+
+            if sum(batch_sizes) >= batch_bytes or len(batch) >= batch_files:
+                tasks.append(CopyTask(item, batch, batch_sizes))
+                batch = []
+                batch_sizes = []
+
+        if batch:
+            tasks.append(CopyTask(item, batch, batch_sizes))
+
+    if largest_first:
+        # Stable sort keeps frames of the same size in the plan order
+        tasks.sort(key=lambda t: t.size, reverse=True)
+
+    return tasks
+
+
+class Scheduler(object):
+    """
+    Small thread pool that runs copy work on several workers at once.
+    Copying is IO bound, so threads are enough to keep storage busy.
+    """
+
+    def __init__(self, workers=4, initializer=None):
+        """
+        :param workers: Number of worker threads
+        :param initializer: Optional callable every worker thread
+            runs before it picks up the first task
+        """
+        self.workers = max(1, int(workers))
+        self.initializer = initializer
+
+    def map(self, func, values):
+        """
+        Call func for every value on the worker threads
+
+        :returns: List of results in the same order as values
+        """
+        values = list(values)
+        results = [None] * len(values)
+
+        def call(index):
+            results[index] = func(values[index])
+
+        self.run(range(len(values)), call)
+
+        return results
+
+    def stat_plan(self, plan, metadata=None):
+        """
+        Look up size of every source file of the plan. Stat calls are
+        issued in parallel as they are slow on network file systems.
+        Sizes are only used to schedule the copies, the copier takes size
+        and times from the opened source
+
+        :param metadata: Optional MetadataCounter the stat calls are counted in
+        """
+        sources = []
+        for item in plan:
+            sources.extend(src for src, dst in item.files)
+
+        stats = self.map(file_stat, sources)
+        if metadata is not None:
+            metadata.add('stat', len(sources))
+
+        start = 0
+        for item in plan:
+            item.sizes = [
+                st.st_size if st is not None else 0
+                for st in stats[start:start + len(item.files)]
+            ]
+            start += len(item.files)
+
+    def run(self, tasks, func, cancelled=None):
+        """
+        Run func for every task in the given order on the worker threads
+
+        :param tasks: Iterable of tasks, workers pick them up in this order
+        :param func: Callable that receives a single task
+        :param cancelled: Optional callable, workers stop taking new
+            tasks once it returns True
+        """
+        tasks = iter(tasks)
+        lock = threading.Lock()
+        errors = []
+
+        def worker():
+            if self.initializer is not None:
+                self.initializer()
+            while not errors:
+                if cancelled is not None and cancelled():
+                    return
+                with lock:
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        return
+                try:
+                    func(task)
+                except Exception as e:
+                    log.exception('Worker failed on %s' % (task, ))
+                    errors.append(e)
+
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=worker, name='consolidator-%s' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            # Join with timeout, so the main thread can still
+            # receive KeyboardInterrupt while the workers are busy
+            while t.is_alive():
+                t.join(0.5)
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,210 @@
+import os
+import re
+import sys
+import time
+import ctypes
+import ctypes.util
+import logging
+import platform
+import threading
+
+from tank.errors import TankError
+
+from .copier import CopyCancelled
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+# ioprio_set is not wrapped by libc, syscall numbers by machine
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+}
+
+# linux/ioprio.h
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+
+# Nice value and best effort IO priority level of low priority copies
+LOW_PRIORITY_NICE = 10
+LOW_PRIORITY_IO_LEVEL = 7
+
+_syscall = None
+
+
+def _get_syscall():
+    """ Lazy load syscall from libc, returns False if it is not available """
+    global _syscall
+
+    if _syscall is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _syscall = libc.syscall
+            _syscall.restype = ctypes.c_long
+        except (OSError, AttributeError, TypeError):
+            _syscall = False
+
+    return _syscall
+
+
+def set_low_priority():
+    """
+    Lower CPU and IO priority of the calling thread, so copies give way
+    to interactive work on the same host and file server.
+
+    Only the calling thread is affected on Linux, which keeps the host
+    application responsive when consolidation runs from the dialog.
+    Other platforms are left untouched.
+    """
+    if not sys.platform.startswith('linux'):
+        log.debug('Low priority mode is only supported on Linux')
+        return
+
+    try:
+        os.nice(LOW_PRIORITY_NICE)
+    except OSError as e:
+        log.debug('Failed to lower CPU priority. %s' % e)
+
+    syscall = _get_syscall()
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not syscall or number is None:
+        log.debug('IO priority is not available on %s' % platform.machine())
+        return
+
+    ioprio = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | LOW_PRIORITY_IO_LEVEL
+    if syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        log.debug('Failed to lower IO priority. %s' % os.strerror(ctypes.get_errno()))
+
+
+def parse_hours(value):
+    """
+    Parse HH:MM-HH:MM time of day range. Ranges that end before they
+    start wrap around midnight, e.g. 20:00-08:00
+
+    :returns: Tuple of (start, end) minutes after midnight or None if empty
+    """
+    if not value:
+        return None
+
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', value.strip())
+    if match is None:
+        raise TankError('Invalid time range "%s", expected HH:MM-HH:MM' % value)
+
+    h1, m1, h2, m2 = [int(i) for i in match.groups()]
+    for hour, minute in [(h1, m1), (h2, m2)]:
+        # 24:00 is accepted as the end of the day
+        if (hour > 23 or minute > 59) and (hour, minute) != (24, 0):
+            raise TankError('Invalid time range "%s", expected HH:MM-HH:MM' % value)
+
+    return (h1 * 60 + m1, h2 * 60 + m2)
+
+
+class BandwidthLimiter(object):
+    """
+    Cap the number of bytes copied per second by all copy workers together.
+
+    Every chunk reserves its slot on a shared timeline before it is written,
+    the worker then sleeps until the slot starts. Unused allowance does not
+    accumulate, so the cap holds after the run was idle for a while.
+
+    The cap can be restricted to working hours, it is lifted outside of them.
+    """
+
+    def __init__(self, rate, hours=None):
+        """
+        :param rate: Maximum bytes per second, 0 disables the cap
+        :param hours: HH:MM-HH:MM local time range the cap applies in.
+            The cap applies at any time if empty
+        """
+        self.rate = rate
+        self.hours = hours or ''
+        self._hours = parse_hours(hours)
+        self._lock = threading.Lock()
+        self._next = 0.0  # Time the next chunk may start at
+
+    def active(self, now=None):
+        """ Check if the cap applies at the given time """
+        if not self.rate:
+            return False
+        if self._hours is None:
+            return True
+
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        start, end = self._hours
+
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+    def consume(self, size, cancel_event=None):
+        """
+        Wait until size bytes can be copied without exceeding the cap
+
+        :param cancel_event: Optional threading.Event that ends the wait early
+        """
+        now = time.time()
+        if not self.active(now):
+            return
+
+        with self._lock:
+            start = max(self._next, now)
+            self._next = start + float(size) / self.rate
+
+        if start > now:
+            if cancel_event is not None:
+                cancel_event.wait(start - now)
+            else:
+                time.sleep(start - now)
+
+    def describe(self):
+        """ Human readable cap for the run summary """
+        if not self.rate:
+            return 'unlimited'
+        text = '%.1f MB/s' % (self.rate / 1048576.0)
+        if self._hours is not None:
+            text += ' during %s, unlimited otherwise' % self.hours
+        return text
+
+
+def throughput_summary(copied, elapsed, limiter=None):
+    """
+    Achieved versus allowed throughput of a run
+
+    :param copied: Number of bytes copied
+    :param elapsed: Copy time in seconds
+    :param limiter: BandwidthLimiter the copies went through, if any
+    """
+    allowed = limiter.describe() if limiter is not None else 'unlimited'
+    return 'Copied %.1f MB in %ds: %.1f MB/s achieved, %s allowed' % (
+        copied / 1048576.0,
+        elapsed,
+        copied / 1048576.0 / max(elapsed, 0.001),
+        allowed
+    )
+
+
+class ThrottledWriter(object):
+    """
+    File object wrapper that passes every write through a BandwidthLimiter
+    and stops writing with CopyCancelled once the cancel event is set
+    """
+
+    def __init__(self, fileobj, limiter=None, cancel_event=None):
+        self._fileobj = fileobj
+        self._limiter = limiter
+        self._cancel_event = cancel_event
+
+    def write(self, data):
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise CopyCancelled('Archive write was cancelled')
+        if self._limiter is not None:
+            self._limiter.consume(len(data), self._cancel_event)
+        return self._fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
@@ -11,8 +11,10 @@ from tank.platform.qt import QtCore, QtGui
 class Ui_Dialog(object):
     def setupUi(self, Dialog):
         Dialog.setObjectName("Dialog")
-        Dialog.resize(431, 392)
-        self.horizontalLayout = QtGui.QHBoxLayout(Dialog)
+        Dialog.resize(560, 520)
+        self.verticalLayout = QtGui.QVBoxLayout(Dialog)
+        self.verticalLayout.setObjectName("verticalLayout")
+        self.horizontalLayout = QtGui.QHBoxLayout()
         self.horizontalLayout.setObjectName("horizontalLayout")
         self.logo_example = QtGui.QLabel(Dialog)
         self.logo_example.setText("")
@@ -20,7 +22,7 @@ class Ui_Dialog(object):
         self.logo_example.setObjectName("logo_example")
         self.horizontalLayout.addWidget(self.logo_example)
         self.context = QtGui.QLabel(Dialog)
-        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Preferred)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
         sizePolicy.setHeightForWidth(self.context.sizePolicy().hasHeightForWidth())
@@ -28,12 +30,94 @@ class Ui_Dialog(object):
         self.context.setAlignment(QtCore.Qt.AlignLeading|QtCore.Qt.AlignLeft|QtCore.Qt.AlignVCenter)
         self.context.setObjectName("context")
         self.horizontalLayout.addWidget(self.context)
+        self.verticalLayout.addLayout(self.horizontalLayout)
+        self.delivery_group = QtGui.QGroupBox(Dialog)
+        self.delivery_group.setObjectName("delivery_group")
+        self.formLayout = QtGui.QFormLayout(self.delivery_group)
+        self.formLayout.setObjectName("formLayout")
+        self.delivery_label = QtGui.QLabel(self.delivery_group)
+        self.delivery_label.setObjectName("delivery_label")
+        self.formLayout.setWidget(0, QtGui.QFormLayout.LabelRole, self.delivery_label)
+        self.delivery_combo = QtGui.QComboBox(self.delivery_group)
+        self.delivery_combo.setObjectName("delivery_combo")
+        self.formLayout.setWidget(0, QtGui.QFormLayout.FieldRole, self.delivery_combo)
+        self.sg_type_label = QtGui.QLabel(self.delivery_group)
+        self.sg_type_label.setObjectName("sg_type_label")
+        self.formLayout.setWidget(1, QtGui.QFormLayout.LabelRole, self.sg_type_label)
+        self.sg_type_layout = QtGui.QHBoxLayout()
+        self.sg_type_layout.setObjectName("sg_type_layout")
+        self.exclude_versions = QtGui.QCheckBox(self.delivery_group)
+        self.exclude_versions.setObjectName("exclude_versions")
+        self.sg_type_layout.addWidget(self.exclude_versions)
+        self.exclude_published_files = QtGui.QCheckBox(self.delivery_group)
+        self.exclude_published_files.setObjectName("exclude_published_files")
+        self.sg_type_layout.addWidget(self.exclude_published_files)
+        self.formLayout.setLayout(1, QtGui.QFormLayout.FieldRole, self.sg_type_layout)
+        self.extension_label = QtGui.QLabel(self.delivery_group)
+        self.extension_label.setObjectName("extension_label")
+        self.formLayout.setWidget(2, QtGui.QFormLayout.LabelRole, self.extension_label)
+        self.extension_filter = QtGui.QLineEdit(self.delivery_group)
+        self.extension_filter.setObjectName("extension_filter")
+        self.formLayout.setWidget(2, QtGui.QFormLayout.FieldRole, self.extension_filter)
+        self.cut_range = QtGui.QCheckBox(self.delivery_group)
+        self.cut_range.setObjectName("cut_range")
+        self.formLayout.setWidget(3, QtGui.QFormLayout.FieldRole, self.cut_range)
+        self.force = QtGui.QCheckBox(self.delivery_group)
+        self.force.setObjectName("force")
+        self.formLayout.setWidget(4, QtGui.QFormLayout.FieldRole, self.force)
+        self.write_back = QtGui.QCheckBox(self.delivery_group)
+        self.write_back.setObjectName("write_back")
+        self.formLayout.setWidget(5, QtGui.QFormLayout.FieldRole, self.write_back)
+        self.verticalLayout.addWidget(self.delivery_group)
+        self.current_asset = QtGui.QLabel(Dialog)
+        self.current_asset.setText("")
+        self.current_asset.setObjectName("current_asset")
+        self.verticalLayout.addWidget(self.current_asset)
+        self.asset_progress = QtGui.QProgressBar(Dialog)
+        self.asset_progress.setProperty("value", 0)
+        self.asset_progress.setObjectName("asset_progress")
+        self.verticalLayout.addWidget(self.asset_progress)
+        self.total_progress = QtGui.QProgressBar(Dialog)
+        self.total_progress.setProperty("value", 0)
+        self.total_progress.setObjectName("total_progress")
+        self.verticalLayout.addWidget(self.total_progress)
+        self.throughput = QtGui.QLabel(Dialog)
+        self.throughput.setText("")
+        self.throughput.setObjectName("throughput")
+        self.verticalLayout.addWidget(self.throughput)
+        self.errors = QtGui.QListWidget(Dialog)
+        self.errors.setObjectName("errors")
+        self.verticalLayout.addWidget(self.errors)
+        self.button_layout = QtGui.QHBoxLayout()
+        self.button_layout.setObjectName("button_layout")
+        spacerItem = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
+        self.button_layout.addItem(spacerItem)
+        self.run_button = QtGui.QPushButton(Dialog)
+        self.run_button.setObjectName("run_button")
+        self.button_layout.addWidget(self.run_button)
+        self.cancel_button = QtGui.QPushButton(Dialog)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.setObjectName("cancel_button")
+        self.button_layout.addWidget(self.cancel_button)
+        self.verticalLayout.addLayout(self.button_layout)
 
         self.retranslateUi(Dialog)
         QtCore.QMetaObject.connectSlotsByName(Dialog)
 
     def retranslateUi(self, Dialog):
-        Dialog.setWindowTitle(QtGui.QApplication.translate("Dialog", "The Current Sgtk Environment", None, QtGui.QApplication.UnicodeUTF8))
+        Dialog.setWindowTitle(QtGui.QApplication.translate("Dialog", "Consolidator", None, QtGui.QApplication.UnicodeUTF8))
         self.context.setText(QtGui.QApplication.translate("Dialog", "Your Current Context: ", None, QtGui.QApplication.UnicodeUTF8))
+        self.delivery_group.setTitle(QtGui.QApplication.translate("Dialog", "Delivery", None, QtGui.QApplication.UnicodeUTF8))
+        self.delivery_label.setText(QtGui.QApplication.translate("Dialog", "Delivery:", None, QtGui.QApplication.UnicodeUTF8))
+        self.sg_type_label.setText(QtGui.QApplication.translate("Dialog", "Exclude types:", None, QtGui.QApplication.UnicodeUTF8))
+        self.exclude_versions.setText(QtGui.QApplication.translate("Dialog", "Version", None, QtGui.QApplication.UnicodeUTF8))
+        self.exclude_published_files.setText(QtGui.QApplication.translate("Dialog", "PublishedFile", None, QtGui.QApplication.UnicodeUTF8))
+        self.extension_label.setText(QtGui.QApplication.translate("Dialog", "Exclude extensions:", None, QtGui.QApplication.UnicodeUTF8))
+        self.extension_filter.setPlaceholderText(QtGui.QApplication.translate("Dialog", "mov jpg", None, QtGui.QApplication.UnicodeUTF8))
+        self.cut_range.setText(QtGui.QApplication.translate("Dialog", "Deliver only frames between shot cut in and cut out", None, QtGui.QApplication.UnicodeUTF8))
+        self.force.setText(QtGui.QApplication.translate("Dialog", "Force consolidation for assets with warnings", None, QtGui.QApplication.UnicodeUTF8))
+        self.write_back.setText(QtGui.QApplication.translate("Dialog", "Record delivered files on Shotgun", None, QtGui.QApplication.UnicodeUTF8))
+        self.run_button.setText(QtGui.QApplication.translate("Dialog", "Consolidate", None, QtGui.QApplication.UnicodeUTF8))
+        self.cancel_button.setText(QtGui.QApplication.translate("Dialog", "Cancel", None, QtGui.QApplication.UnicodeUTF8))
 
 from . import resources_rc
@@ -0,0 +1,93 @@
+import re
+import logging
+
+from tank.errors import TankError
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+# Used when the project does not configure "version_patterns"
+DEFAULT_VERSION_PATTERNS = [
+    '([vV])(?P<version_number>[0-9]+)',  # v001, V00001
+    '([A-Za-z]+)_(?P<version_number>[0-9]+)'  # name_01
+]
+
+
+def compile_version_patterns(patterns=None):
+    """
+    Compile version patterns once per run. Every pattern has to
+    capture the number in a "version_number" group
+    """
+    compiled = []
+    for p in patterns or DEFAULT_VERSION_PATTERNS:
+        regex = re.compile(p)
+        if 'version_number' not in regex.groupindex:
+            raise TankError('Version pattern %s has no version_number group' % p)
+        compiled.append(regex)
+    return compiled
+
+
+def version_from_name(name, patterns):
+    """
+    Determine version number from a name using the first pattern that matches.
+    The last match wins, e.g. for 'rvb300_match_30mlCamZv03_v006.fbx'
+    the version is 6, not 3.
+
+    :param patterns: Compiled patterns, see compile_version_patterns
+    :returns: None or integer
+    """
+    for p in patterns:
+        version = None
+        for match in p.finditer(name):
+            version = int(match.group('version_number'))
+        if version is not None:
+            return version
+
+    return None
+
+
+class FinalVersionIndex(object):
+    """
+    Final version numbers of the project by entity id.
+
+    Built once per run out of Delivery.all_delivery_versions, so every asset
+    is resolved with a dictionary lookup. Version codes no pattern matches
+    are kept in self.unparsed, assets of those entities fall back to
+    their own version.
+    """
+
+    def __init__(self, final_versions, patterns):
+        """
+        :param final_versions: Final Version dictionaries by entity id
+        :param patterns: Compiled patterns, see compile_version_patterns
+        """
+        self.versions = {}  # Final version number by entity id
+        self.unparsed = {}  # Final version code by entity id
+
+        for entity_id, sg_version in final_versions.items():
+            code = sg_version.get('code') or ''
+            number = version_from_name(code, patterns)
+            if number is None:
+                self.unparsed[entity_id] = code or 'Version %s' % sg_version.get('id')
+            else:
+                self.versions[entity_id] = number
+
+    def get(self, entity_id):
+        """ :returns: Final version number of the entity or None """
+        return self.versions.get(entity_id)
+
+    def report_unparsed(self, entity_ids):
+        """
+        Log final version codes of the given entities that could not be
+        parsed, all at once before the assets are resolved
+        """
+        codes = sorted(set(
+            self.unparsed[i] for i in entity_ids if i in self.unparsed
+        ))
+        if not codes:
+            return
+
+        log.warning(
+            'Failed to parse final version number from %s version codes, '
+            'asset versions are used instead:\n    %s'
+            % (len(codes), '\n    '.join(codes))
+        )
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import errno
+import shutil
+import socket
+import logging
+import threading
+import contextlib
+from collections import namedtuple
+
+from .scheduler import build_tasks
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+# Stand-in for an asset in the merged summary of a sharded run.
+# Workers that did not resolve the plan only know asset names.
+QueuedAsset = namedtuple('QueuedAsset', ['name'])
+
+
+def make_shards(plan, shard_bytes):
+    """
+    Split resolved plan into shards of roughly shard_bytes each.
+
+    Shards are filled with the largest tasks first, so hosts that claim
+    the first shards start with the biggest files.
+
+    :returns: List of shard dictionaries ready to be stored as json
+    """
+    shards = []
+    items = {}
+    size = 0
+
+    def flush():
+        shards.append({
+            'id': 'shard-%04d' % len(shards),
+            'items': list(items.values()),
+            'size': size
+        })
+
+    for task in build_tasks(plan):
+        name = task.item.name
+        if name not in items:
+            items[name] = {'asset': name, 'files': [], 'sizes': []}
+        items[name]['files'].extend([src, dst] for src, dst in task.files)
+        items[name]['sizes'].extend(task.sizes)
+        size += task.size
+
+        if size >= shard_bytes:
+            flush()
+            items = {}
+            size = 0
+
+    if items:
+        flush()
+
+    return shards
+
+
+def _write_json(path, data):
+    """ Write json next to the destination and rename it into place """
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.rename(tmp, path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class WorkQueue(object):
+    """
+    Work queue of a single delivery stored on the shared file system.
+
+    The queue is a directory with a manifest and one json file per shard.
+    A shard moves between pending, claimed and done sub directories with
+    atomic renames, so only one host can claim it. Claimed shards carry the
+    worker host name in the file name and are touched regularly while
+    the worker is alive. Claims that were not touched for stale_timeout
+    seconds are moved back to pending so another host can pick them up.
+    A worker that finds its claim gone stops copying the shard, and the
+    first result stored for a shard is kept.
+
+    Creating the queue and recovering stale claims happen under a lock
+    directory, mkdir is atomic on NFS and SMB mounts.
+    """
+
+    def __init__(self, root, stale_timeout=300, lock_timeout=60):
+        """
+        :param root: Queue directory on the shared file system
+        :param stale_timeout: Seconds after an untouched claim is recovered
+        :param lock_timeout: Seconds after an abandoned lock is broken
+        """
+        self.root = root
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.worker_id = '%s-%s' % (socket.gethostname(), os.getpid())
+
+        self._manifest_path = os.path.join(root, 'manifest.json')
+        self._summary_path = os.path.join(root, 'summary.json')
+        self._lock_path = os.path.join(root, 'lock')
+        self._pending = os.path.join(root, 'pending')
+        self._claimed = os.path.join(root, 'claimed')
+        self._done = os.path.join(root, 'done')
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Hold the queue lock, waiting for other hosts to release it.
+        The lock is touched while it is held, so a lock of a dead host
+        can be told apart from a lock held during a long operation.
+        """
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        while True:
+            try:
+                os.mkdir(self._lock_path)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                age = time.time() - os.path.getmtime(self._lock_path)
+            except OSError:
+                # Lock was released in the meantime
+                continue
+            if age > self.lock_timeout:
+                log.warning('Breaking abandoned work queue lock %s' % self._lock_path)
+                try:
+                    os.rmdir(self._lock_path)
+                except OSError:
+                    pass
+                continue
+            time.sleep(1)
+
+        stop = self._keep_alive(self._lock_path, self.lock_timeout)
+        try:
+            yield
+        finally:
+            stop.set()
+            os.rmdir(self._lock_path)
+
+    def _keep_alive(self, path, timeout, lost=None):
+        """
+        Touch the path from a background thread until the returned
+        event is set or the path disappears
+
+        :param lost: Optional threading.Event set when the path disappears
+        """
+        stop = threading.Event()
+        interval = max(1, timeout / 4.0)
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    log.warning('Lost %s' % path)
+                    if lost is not None:
+                        lost.set()
+                    return
+
+        t = threading.Thread(target=beat, name='consolidator-heartbeat')
+        t.daemon = True
+        t.start()
+
+        return stop
+
+    def exists(self):
+        return os.path.exists(self._manifest_path)
+
+    def reset(self):
+        """ Remove queue of the previous run. Call under the lock """
+        for name in ['pending', 'claimed', 'done']:
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        for path in [self._manifest_path, self._summary_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def create(self, shards, assets, failed, fingerprint=None):
+        """
+        Store shards of the resolved plan. Call under the lock
+
+        :param shards: List of shards, see make_shards
+        :param assets: Names of all assets requested for consolidation
+        :param failed: Names of assets that failed to resolve
+        :param fingerprint: Hash of the inputs the plan was built from,
+            used to tell if the queue is still up to date
+        """
+        for path in [self._pending, self._claimed, self._done]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        for shard in shards:
+            _write_json(os.path.join(self._pending, shard['id'] + '.json'), shard)
+
+        # Manifest is written last, it marks the queue as ready
+        _write_json(self._manifest_path, {
+            'assets': assets,
+            'failed': failed,
+            'shards': dict(
+                (s['id'], [i['asset'] for i in s['items']]) for s in shards
+            ),
+            'fingerprint': fingerprint,
+            'created_by': self.worker_id,
+            'created': time.time()
+        })
+
+        log.info('Created work queue %s with %s shards' % (self.root, len(shards)))
+
+    def manifest(self):
+        return _read_json(self._manifest_path)
+
+    def claim(self):
+        """
+        Claim the next pending shard
+
+        :returns: Claimed shard dictionary or None if nothing is pending
+        """
+        done = set(os.listdir(self._done))
+
+        for name in sorted(os.listdir(self._pending)):
+            shard_id = os.path.splitext(name)[0]
+            if name in done:
+                # Finished by a worker whose claim was recovered meanwhile
+                try:
+                    os.remove(os.path.join(self._pending, name))
+                except OSError:
+                    pass
+                continue
+            claim_path = os.path.join(self._claimed, '%s@%s.json' % (shard_id, self.worker_id))
+            try:
+                os.rename(os.path.join(self._pending, name), claim_path)
+            except OSError:
+                # Another host was faster
+                continue
+            os.utime(claim_path, None)
+            if os.path.exists(os.path.join(self._done, name)):
+                # Shard finished between listing and claiming it
+                os.remove(claim_path)
+                continue
+            shard = _read_json(claim_path)
+            shard['claim_path'] = claim_path
+            log.info('Claimed %s, %.1f MB' % (shard_id, shard['size'] / 1048576.0))
+            return shard
+
+        return None
+
+    def release(self, shard):
+        """ Put unfinished shard back to the queue """
+        try:
+            os.rename(shard['claim_path'], os.path.join(self._pending, shard['id'] + '.json'))
+        except OSError:
+            pass
+
+    def complete(self, shard, result):
+        """
+        Store the shard result and drop the claim. Result of a worker
+        that finished the shard first is kept
+
+        :param result: Dictionary with the shard copy results
+        """
+        done_path = os.path.join(self._done, shard['id'] + '.json')
+        result = dict(result, worker=self.worker_id, finished=time.time())
+
+        with self.lock():
+            if os.path.exists(done_path):
+                log.warning('%s was already finished by another worker' % shard['id'])
+            else:
+                _write_json(done_path, result)
+
+        try:
+            os.remove(shard['claim_path'])
+        except OSError:
+            log.warning('Claim of %s was recovered by another worker' % shard['id'])
+
+    def recover_stale(self):
+        """ Move claims of dead workers back to pending """
+        now = time.time()
+        with self.lock():
+            for name in os.listdir(self._claimed):
+                path = os.path.join(self._claimed, name)
+                try:
+                    age = now - os.path.getmtime(path)
+                except OSError:
+                    continue
+                if age < self.stale_timeout:
+                    continue
+                shard_id, worker = os.path.splitext(name)[0].split('@', 1)
+                if os.path.exists(os.path.join(self._done, shard_id + '.json')):
+                    os.remove(path)
+                    continue
+                log.warning(
+                    'Worker %s did not report for %ds, recovering %s'
+                    % (worker, age, shard_id)
+                )
+                try:
+                    os.rename(path, os.path.join(self._pending, shard_id + '.json'))
+                except OSError:
+                    pass
+
+    def is_finished(self):
+        done = set(os.path.splitext(n)[0] for n in os.listdir(self._done))
+        return set(self.manifest()['shards']) <= done
+
+    def summary(self):
+        """
+        Merge results of all finished shards
+
+        :returns: Tuple of (assets, completed, finished). Assets are
+            QueuedAsset instances, finished is True if every shard is done
+        """
+        manifest = self.manifest()
+        failed = set(manifest['failed'])
+        finished = True
+
+        for shard_id, shard_assets in manifest['shards'].items():
+            path = os.path.join(self._done, shard_id + '.json')
+            if not os.path.exists(path):
+                # Assets of unfinished shards are not complete yet
+                failed.update(shard_assets)
+                finished = False
+                continue
+            result = _read_json(path)
+            failed.update(result['failed'])
+            failed.update(result['incomplete'])
+
+        assets = [QueuedAsset(a) for a in manifest['assets']]
+        completed = [a for a in assets if a.name not in failed]
+
+        if finished:
+            _write_json(self._summary_path, {
+                'assets': manifest['assets'],
+                'completed': [a.name for a in completed]
+            })
+
+        return assets, completed, finished
+
+    def start_heartbeat(self, shard, lost=None):
+        """
+        Keep the shard claim alive until the returned event is set
+
+        :param lost: Optional threading.Event set when the claim was recovered
+            by another worker, the shard must not be copied any further
+        """
+        return self._keep_alive(shard['claim_path'], self.stale_timeout, lost)
@@ -0,0 +1,196 @@
+import os
+import hashlib
+import logging
+
+log = logging.getLogger('tank.setup_project.consolidator')
+
+
+def combine_checksums(checksums):
+    """
+    Single checksum for an asset out of its file checksums. Sequences get
+    a checksum of their frame checksums in frame order.
+    """
+    if len(checksums) == 1:
+        return checksums[0]
+
+    h = hashlib.md5()
+    for c in checksums:
+        h.update(c.encode('ascii'))
+    return h.hexdigest()
+
+
+class WriteBack(object):
+    """
+    Record consolidation results on Shotgun.
+
+    Delivered paths, sizes, checksums and status are written to the
+    Version and PublishedFile entities the assets came from and to the
+    Delivery itself. All updates are sent with sg.batch() in chunks of
+    batch_size requests. Values are compared with the data fetched by
+    the Delivery queries, so records that did not change since the last
+    run are not written again.
+    """
+
+    def __init__(self, sg, fields, status='', delivery_status='', batch_size=100):
+        """
+        :param sg: Shotgun API instance
+        :param fields: Dictionary mapping "path", "size" and "checksum"
+            to Shotgun field names. Missing keys are not written
+        :param status: Status set on Versions and PublishedFiles once
+            all of their assets were delivered. Not set if empty
+        :param delivery_status: Status set on the Delivery once all
+            of its assets were delivered. Not set if empty
+        :param batch_size: Maximum number of requests in one sg.batch() call
+        """
+        self.sg = sg
+        self.fields = fields
+        self.status = status
+        self.delivery_status = delivery_status
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_app(cls, app):
+        """ Create write back configured by the app settings """
+        return cls(
+            app.shotgun,
+            app.get_setting('write_back_fields', {}),
+            status=app.get_setting('write_back_status', ''),
+            delivery_status=app.get_setting('write_back_delivery_status', ''),
+            batch_size=app.get_setting('write_back_batch_size', 100)
+        )
+
+    @staticmethod
+    def query_fields(app):
+        """ Shotgun fields the Delivery queries need to fetch for comparison """
+        fields = list(app.get_setting('write_back_fields', {}).values())
+        return fields + ['sg_status_list']
+
+    def _request(self, entity_type, entity_id, sg_data, values):
+        """
+        Build update request for the values that differ from sg_data
+
+        :returns: Batch request dictionary or None if nothing changed
+        """
+        data = {}
+        for key, value in values.items():
+            field = self.fields.get(key) if key != 'status' else 'sg_status_list'
+            if not field or value is None or value == '':
+                continue
+            if sg_data.get(field) == value:
+                continue
+            data[field] = value
+
+        if not data:
+            log.debug('%s %s is up to date on Shotgun' % (entity_type, entity_id))
+            return None
+
+        return {
+            'request_type': 'update',
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'data': data
+        }
+
+    def build_requests(self, sg_delivery, plan, assets, completed, checksums,
+                       archive=None, whole_delivery=True):
+        """
+        Collect updates for every record touched by the consolidation
+
+        :param sg_delivery: Delivery object
+        :param plan: CopyPlan that was consolidated
+        :param assets: All assets requested for consolidation
+        :param completed: Assets that have been consolidated
+        :param checksums: Dictionary of file checksums by destination path
+        :param archive: Closed ArchiveWriter of archive deliveries. Records
+            get archive:member paths and the Delivery the archive path
+        :param whole_delivery: False if the assets were filtered, the Delivery
+            itself is only updated by runs that cover all of its assets
+        :returns: List of batch requests
+        """
+        records = {}  # Delivered values by (entity type, entity id)
+        order = []
+
+        def record(asset):
+            key = (asset.sg_data['type'], asset.sg_data['id'])
+            if key not in records:
+                records[key] = {
+                    'sg_data': asset.sg_data,
+                    'paths': [],
+                    'size': 0,
+                    'checksums': [],
+                    'complete': True
+                }
+                order.append(key)
+            return records[key]
+
+        # Assets that failed to resolve never made it to the plan
+        for asset in assets:
+            if asset not in completed:
+                record(asset)['complete'] = False
+
+        for item in plan:
+            if item.asset not in completed:
+                continue
+            r = record(item.asset)
+            if archive is not None:
+                path = '%s:%s' % (archive.path, archive.member_name(item.delivery_path))
+            else:
+                path = item.delivery_path
+            r['paths'].append(path)
+            r['size'] += item.size
+
+            sums = [checksums.get(dst) for dst in item.destinations]
+            if None not in sums:
+                r['checksums'].append('%s  %s' % (combine_checksums(sums), path))
+
+        requests = []
+
+        for key in order:
+            r = records[key]
+            values = {'status': self.status if r['complete'] else None}
+            if r['paths']:
+                values['path'] = '\n'.join(sorted(r['paths']))
+                values['size'] = r['size']
+                values['checksum'] = '\n'.join(sorted(r['checksums'])) or None
+
+            request = self._request(key[0], key[1], r['sg_data'], values)
+            if request is not None:
+                requests.append(request)
+
+        # Delivery gets the archive or the common folder of all files
+        destinations = []
+        for item in plan:
+            if item.asset in completed:
+                destinations.extend(item.destinations)
+
+        if archive is not None:
+            delivery_path = archive.path
+        elif destinations:
+            delivery_path = os.path.dirname(os.path.commonprefix(destinations))
+        else:
+            delivery_path = None
+
+        # Partial, cancelled or filtered runs keep the values
+        # recorded by the last complete delivery
+        all_completed = bool(assets) and len(completed) == len(assets)
+        if whole_delivery and all_completed:
+            request = self._request(
+                sg_delivery.sg_entity_type, sg_delivery.id, sg_delivery.sg_data, {
+                    'path': delivery_path,
+                    'size': sum(i.size for i in plan if i.asset in completed),
+                    'status': self.delivery_status
+                }
+            )
+            if request is not None:
+                requests.append(request)
+
+        return requests
+
+    def commit(self, requests):
+        """ Send update requests to Shotgun in batches """
+        for start in range(0, len(requests), self.batch_size):
+            chunk = requests[start:start + self.batch_size]
+            log.debug('Sending %s updates to Shotgun' % len(chunk))
+            self.sg.batch(chunk)
+
+        log.info('Recorded consolidation results on %s Shotgun records' % len(requests))